@@ -1,17 +1,39 @@
+import argparse
 import asyncio
+import bisect
 import contextlib
+import functools
+import hashlib
+import itertools
 import json
 import math
-import random
+import multiprocessing
+import multiprocessing.queues
+import os
+import queue
+import re
+import shutil
+import struct
+import sys
+import threading
 import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
 import cv2
 import numpy as np
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = FastAPI()
 
@@ -25,38 +47,228 @@ app.add_middleware(
 
 ROOT_DIR = Path(__file__).resolve().parent.parent
 MAP_PATH = ROOT_DIR / "map.png"
+COLLISION_CACHE_DIR = Path(os.environ.get("COLLISION_CACHE_DIR", ROOT_DIR / ".cache" / "collision"))
+MAX_AGENTS = int(os.environ.get("CROWD_MAX_AGENTS", "10"))
+WORKER_PROCESS = os.environ.get("CROWD_WORKER_PROCESS", "0") == "1"
+AUDIO_DSP_WORKERS = int(os.environ.get("AUDIO_DSP_WORKERS", "4"))
+DANGER_FRAME_SIZE = int(os.environ.get("DANGER_FRAME_SIZE", "2048"))
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") == "1"
+PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL", "0.01"))
+JSON_ENCODER = os.environ.get("CROWD_JSON_ENCODER", "orjson" if orjson is not None else "json")
+DEFAULT_ROOM = "default"
+MAX_ROOMS = int(os.environ.get("CROWD_MAX_ROOMS", "64"))
+ROOM_IDLE_SECONDS = float(os.environ.get("CROWD_ROOM_IDLE_SECONDS", "300"))
+HEATMAP_INTERVAL = float(os.environ.get("CROWD_HEATMAP_INTERVAL", "0.25"))
+GOALS_MIN_INTERVAL = float(os.environ.get("CROWD_GOALS_MIN_INTERVAL", "1.0"))
+TRAJECTORY_LOG_DIR = os.environ.get("TRAJECTORY_LOG_DIR", str(ROOT_DIR / ".cache" / "trajectories"))
+TRAJECTORY_ROOMS = os.environ.get("TRAJECTORY_ROOMS", DEFAULT_ROOM)
+TRAJECTORY_SEGMENT_MB = int(os.environ.get("TRAJECTORY_SEGMENT_MB", "16"))
+TRAJECTORY_SEGMENTS = int(os.environ.get("TRAJECTORY_SEGMENTS", "4"))
+CROWD_GOALS = [
+    (float(x), float(y))
+    for x, y in (point.split(",") for point in os.environ.get("CROWD_GOALS", "").split(";") if point.strip())
+]
+
+class TiledWalkableMask:
+    def __init__(self, packed: np.ndarray, counts: np.ndarray, width: int, height: int, cache_tiles: int = 64):
+        self.packed = packed
+        self.counts = counts
+        self.width = width
+        self.height = height
+        self.tile_size = int(math.isqrt(packed.shape[2] * 8))
+        self.tiles_y, self.tiles_x = counts.shape
+        self.full_count = self.tile_size * self.tile_size
+        self.prefix = np.cumsum(counts.ravel(), dtype=np.int64)
+        self.total = int(self.prefix[-1]) if len(self.prefix) else 0
+        self.cache_tiles = cache_tiles
+        self._tiles: "OrderedDict[Tuple[int, int], np.ndarray]" = OrderedDict()
+
+    @classmethod
+    def pack_band(cls, band: np.ndarray, tile_size: int, tiles_x: int) -> Tuple[np.ndarray, np.ndarray]:
+        padded = np.zeros((tile_size, tiles_x * tile_size), dtype=np.bool_)
+        padded[: band.shape[0], : band.shape[1]] = band
+        blocks = padded.reshape(tile_size, tiles_x, tile_size).transpose(1, 0, 2).reshape(tiles_x, -1)
+        return np.packbits(blocks, axis=1), np.count_nonzero(blocks, axis=1).astype(np.int32)
+
+    def tile(self, ty: int, tx: int) -> np.ndarray:
+        key = (ty, tx)
+        cached = self._tiles.get(key)
+        if cached is not None:
+            self._tiles.move_to_end(key)
+            return cached
+        unpacked = np.unpackbits(self.packed[ty, tx]).view(np.bool_).reshape(self.tile_size, self.tile_size)
+        self._tiles[key] = unpacked
+        if len(self._tiles) > self.cache_tiles:
+            self._tiles.popitem(last=False)
+        return unpacked
+
+    def contains(self, ix: np.ndarray, iy: np.ndarray) -> np.ndarray:
+        tx = ix // self.tile_size
+        ty = iy // self.tile_size
+        counts = self.counts[ty, tx]
+        walkable = counts == self.full_count
+        mixed = np.flatnonzero((counts > 0) & ~walkable)
+        if mixed.size:
+            local = (iy[mixed] % self.tile_size) * self.tile_size + ix[mixed] % self.tile_size
+            packed = self.packed[ty[mixed], tx[mixed], local >> 3]
+            walkable[mixed] = (packed >> (7 - (local & 7))) & 1
+        return walkable
+
+    def region(self, y0: int, y1: int, x0: int, x1: int) -> np.ndarray:
+        out = np.zeros((y1 - y0, x1 - x0), dtype=np.bool_)
+        size = self.tile_size
+        for ty in range(y0 // size, (y1 - 1) // size + 1):
+            for tx in range(x0 // size, (x1 - 1) // size + 1):
+                count = self.counts[ty, tx]
+                top, left = max(y0, ty * size), max(x0, tx * size)
+                bottom, right = min(y1, (ty + 1) * size), min(x1, (tx + 1) * size)
+                if count == 0:
+                    continue
+                if count == self.full_count:
+                    out[top - y0 : bottom - y0, left - x0 : right - x0] = True
+                    continue
+                tile = self.tile(ty, tx)
+                out[top - y0 : bottom - y0, left - x0 : right - x0] = tile[
+                    top - ty * size : bottom - ty * size, left - tx * size : right - tx * size
+                ]
+        return out
+
+    def sample(self, count: int, rng: np.random.Generator) -> np.ndarray:
+        ranks = rng.integers(0, self.total, size=count, dtype=np.int64)
+        flat_tiles = np.searchsorted(self.prefix, ranks, side="right")
+        offsets = ranks - (self.prefix[flat_tiles] - self.counts.ravel()[flat_tiles])
+        points = np.empty((count, 2), dtype=np.float32)
+        for flat_tile in np.unique(flat_tiles):
+            ty, tx = divmod(int(flat_tile), self.tiles_x)
+            chosen = flat_tiles == flat_tile
+            local_y, local_x = np.divmod(np.flatnonzero(self.tile(ty, tx))[offsets[chosen]], self.tile_size)
+            points[chosen, 0] = local_x + tx * self.tile_size
+            points[chosen, 1] = local_y + ty * self.tile_size
+        return points
+
 
 class CollisionField:
 
     TARGET_BGR = np.array([0x87, 0xB3, 0xBF], dtype=np.uint8)
     COLOR_TOLERANCE = 24.0
+    CLOSE_KERNEL = 5
+    OPEN_KERNEL = 3
+    TILE_SIZE = 256
+    BAND_PADDING = 8
+    SNAP_MARGIN = 96
     DEFAULT_SPAWN_MARGIN = 30
+    CACHE_VERSION = 2
+    CACHE_ARRAYS = ("packed_tiles", "tile_counts")
 
-    def __init__(self, image_path: Path):
-        self.source_image = cv2.imread(str(image_path), cv2.IMREAD_COLOR)
-        if self.source_image is None:
+    def __init__(
+        self, image_path: Path, cache_dir: Optional[Path] = None, cache_tiles: int = 64, seed: Optional[int] = None
+    ):
+        if not Path(image_path).is_file():
             raise FileNotFoundError(f"Map image not found at {image_path}")
+        image_bytes = Path(image_path).read_bytes()
+        key = self.cache_key(image_bytes)
+        self.image_path = Path(image_path)
+        self.cache_dir = cache_dir
+
+        artifact = self._load_artifact(cache_dir / key) if cache_dir is not None else None
+        if artifact is None:
+            artifact = self._build_artifact(image_bytes, image_path)
+            if cache_dir is not None:
+                self._save_artifact(cache_dir / key, *artifact)
+
+        arrays, (self.height, self.width) = artifact
+        self.tiles = TiledWalkableMask(
+            arrays["packed_tiles"], arrays["tile_counts"], self.width, self.height, cache_tiles=cache_tiles
+        )
+        self._nearest_cache: "OrderedDict[Tuple[int, int], Optional[Tuple[int, int, int, np.ndarray]]]"
+        self._nearest_cache = OrderedDict()
+        self.cache_tiles = cache_tiles
+        self._navigation: Optional["NavigationGrid"] = None
+        self.rng = np.random.default_rng(seed)
+
+    def navigation(self) -> "NavigationGrid":
+        if self._navigation is None:
+            self._navigation = NavigationGrid(self.tiles)
+        return self._navigation
+
+    @property
+    def walkable_count(self) -> int:
+        return self.tiles.total
+
+    @classmethod
+    def cache_params(cls) -> Dict[str, object]:
+        return {
+            "version": cls.CACHE_VERSION,
+            "target_bgr": cls.TARGET_BGR.tolist(),
+            "color_tolerance": cls.COLOR_TOLERANCE,
+            "close_kernel": cls.CLOSE_KERNEL,
+            "open_kernel": cls.OPEN_KERNEL,
+            "tile_size": cls.TILE_SIZE,
+        }
+
+    @classmethod
+    def cache_key(cls, image_bytes: bytes) -> str:
+        digest = hashlib.sha256(image_bytes)
+        digest.update(json.dumps(cls.cache_params(), sort_keys=True).encode())
+        return f"v{cls.CACHE_VERSION}-{digest.hexdigest()[:24]}"
 
-        self.walkable_mask = self._build_walkable_mask(self.source_image)
-        self.height, self.width = self.walkable_mask.shape
+    def _build_artifact(self, image_bytes: bytes, image_path: Path) -> Tuple[Dict[str, np.ndarray], Tuple[int, int]]:
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise FileNotFoundError(f"Map image not found at {image_path}")
 
-        walkable_coords = np.column_stack(np.where(self.walkable_mask))
-        if walkable_coords.size == 0:
+        height, width = image.shape[:2]
+        size = self.TILE_SIZE
+        tiles_y, tiles_x = -(-height // size), -(-width // size)
+        packed = np.zeros((tiles_y, tiles_x, size * size // 8), dtype=np.uint8)
+        counts = np.zeros((tiles_y, tiles_x), dtype=np.int32)
+        for ty in range(tiles_y):
+            y0, y1 = ty * size, min((ty + 1) * size, height)
+            top, bottom = max(0, y0 - self.BAND_PADDING), min(height, y1 + self.BAND_PADDING)
+            band = self._build_walkable_mask(image[top:bottom])[y0 - top : y1 - top]
+            packed[ty], counts[ty] = TiledWalkableMask.pack_band(band, size, tiles_x)
+
+        if not counts.any():
             raise ValueError(
                 "No walkable region detected in map.png. Ensure paths use #bfb387 (and similar hues)."
             )
-        self.walkable_coords = walkable_coords
-        self._margin_cache: Dict[int, np.ndarray] = {}
+        return {"packed_tiles": packed, "tile_counts": counts}, (height, width)
+
+    def _load_artifact(self, artifact_dir: Path) -> Optional[Tuple[Dict[str, np.ndarray], Tuple[int, int]]]:
+        try:
+            manifest = json.loads((artifact_dir / "manifest.json").read_text())
+            if manifest.get("params") != self.cache_params():
+                return None
+            arrays = {name: np.load(artifact_dir / f"{name}.npy", mmap_mode="r") for name in self.CACHE_ARRAYS}
+            height, width = manifest["shape"]
+            return arrays, (height, width)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save_artifact(self, artifact_dir: Path, arrays: Dict[str, np.ndarray], shape: Tuple[int, int]) -> None:
+        staging = artifact_dir.with_name(f"{artifact_dir.name}.tmp-{os.getpid()}")
+        try:
+            staging.mkdir(parents=True, exist_ok=True)
+            for name in self.CACHE_ARRAYS:
+                np.save(staging / f"{name}.npy", arrays[name])
+            manifest = {"params": self.cache_params(), "shape": list(shape)}
+            (staging / "manifest.json").write_text(json.dumps(manifest))
+            os.replace(staging, artifact_dir)
+        except OSError as exc:
+            shutil.rmtree(staging, ignore_errors=True)
+            if not artifact_dir.is_dir():
+                print(f"Could not write collision cache to {artifact_dir}: {exc}")
 
     def _build_walkable_mask(self, image: np.ndarray) -> np.ndarray:
         lab_image = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
         target_lab = cv2.cvtColor(self.TARGET_BGR.reshape(1, 1, 3), cv2.COLOR_BGR2LAB)[0, 0]
 
-        delta = np.linalg.norm(lab_image.astype(np.int16) - target_lab.astype(np.int16), axis=2)
-        mask = (delta <= self.COLOR_TOLERANCE).astype(np.uint8) * 255
+        delta = cv2.absdiff(lab_image, np.full_like(lab_image, target_lab)).astype(np.float32)
+        dist_sq = cv2.transform(cv2.multiply(delta, delta), np.ones((1, 3), dtype=np.float32))
+        mask = (dist_sq <= self.COLOR_TOLERANCE ** 2).astype(np.uint8) * 255
 
-        kernel_close = np.ones((5, 5), np.uint8)
-        kernel_open = np.ones((3, 3), np.uint8)
+        kernel_close = np.ones((self.CLOSE_KERNEL, self.CLOSE_KERNEL), np.uint8)
+        kernel_open = np.ones((self.OPEN_KERNEL, self.OPEN_KERNEL), np.uint8)
         mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel_close)
         mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel_open)
 
@@ -66,111 +278,872 @@ class CollisionField:
         ix, iy = int(round(x)), int(round(y))
         if ix < 0 or iy < 0 or ix >= self.width or iy >= self.height:
             return False
-        return bool(self.walkable_mask[iy, ix])
+        return bool(self.tiles.contains(np.array([ix]), np.array([iy]))[0])
+
+    def are_walkable(self, points: np.ndarray) -> np.ndarray:
+        ix = np.rint(points[:, 0]).astype(np.int64)
+        iy = np.rint(points[:, 1]).astype(np.int64)
+        inside = (ix >= 0) & (iy >= 0) & (ix < self.width) & (iy < self.height)
+        walkable = np.zeros(len(points), dtype=bool)
+        walkable[inside] = self.tiles.contains(ix[inside], iy[inside])
+        return walkable
+
+    def random_walkable_points(
+        self, count: int, margin: int = 0, attempts: int = 8, rng: Optional[np.random.Generator] = None
+    ) -> np.ndarray:
+        rng = rng or self.rng
+        points = self.tiles.sample(count, rng)
+        if margin <= 0 or 2 * margin >= min(self.width, self.height):
+            return points
+        for _ in range(attempts):
+            outside = np.flatnonzero(
+                (points[:, 0] < margin)
+                | (points[:, 0] >= self.width - margin)
+                | (points[:, 1] < margin)
+                | (points[:, 1] >= self.height - margin)
+            )
+            if outside.size == 0:
+                break
+            points[outside] = self.tiles.sample(outside.size, rng)
+        return points
+
+    def cluster_origin(self, rng: Optional[np.random.Generator] = None) -> Tuple[float, float]:
+        subset = self.tiles.sample(min(500, self.walkable_count), rng or self.rng)
+        mean_x, mean_y = subset.mean(axis=0)
+        return float(mean_x), float(mean_y)
 
-    def random_walkable_point(self, margin: int = 0) -> Tuple[float, float]:
-        coords = self._coords_with_margin(margin)
-        iy, ix = coords[np.random.randint(len(coords))]
-        return float(ix), float(iy)
+    def snap_many(
+        self, points: np.ndarray, max_radius: int = 80, rng: Optional[np.random.Generator] = None
+    ) -> np.ndarray:
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        snapped = points.copy()
+        blocked = np.flatnonzero(~self.are_walkable(points))
+        if blocked.size == 0:
+            return snapped
+
+        ix = np.clip(np.rint(points[blocked, 0]), 0, self.width - 1).astype(np.int64)
+        iy = np.clip(np.rint(points[blocked, 1]), 0, self.height - 1).astype(np.int64)
+        size = self.tiles.tile_size
+        tile_keys = (iy // size) * self.tiles.tiles_x + ix // size
+        stranded_mask = np.zeros(len(blocked), dtype=bool)
+        for tile_key in np.unique(tile_keys):
+            ty, tx = divmod(int(tile_key), self.tiles.tiles_x)
+            chosen = np.flatnonzero(tile_keys == tile_key)
+            nearest = self._nearest_for_tile(ty, tx)
+            if nearest is None:
+                stranded_mask[chosen] = True
+                continue
+            top, left, window_width, index = nearest
+            flat = index[iy[chosen] - ty * size, ix[chosen] - tx * size]
+            nearest_y, nearest_x = np.divmod(flat, window_width)
+            snapped[blocked[chosen], 0] = nearest_x + left
+            snapped[blocked[chosen], 1] = nearest_y + top
+
+        reach = np.abs(snapped[blocked] - points[blocked]).max(axis=1)
+        stranded = blocked[stranded_mask | (reach > max_radius)]
+        if stranded.size:
+            snapped[stranded] = self.random_walkable_points(stranded.size, rng=rng)
+        return snapped
+
+    def _nearest_for_tile(self, ty: int, tx: int) -> Optional[Tuple[int, int, int, np.ndarray]]:
+        key = (ty, tx)
+        if key in self._nearest_cache:
+            self._nearest_cache.move_to_end(key)
+            return self._nearest_cache[key]
+
+        size = self.tiles.tile_size
+        top, left = max(0, ty * size - self.SNAP_MARGIN), max(0, tx * size - self.SNAP_MARGIN)
+        bottom = min(self.height, (ty + 1) * size + self.SNAP_MARGIN)
+        right = min(self.width, (tx + 1) * size + self.SNAP_MARGIN)
+        window = self.tiles.region(top, bottom, left, right)
+        nearest: Optional[Tuple[int, int, int, np.ndarray]] = None
+        if window.any():
+            _, labels = cv2.distanceTransformWithLabels(
+                (~window).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_5, labelType=cv2.DIST_LABEL_PIXEL
+            )
+            label_to_index = np.zeros(int(labels.max()) + 1, dtype=np.int32)
+            label_to_index[labels[window]] = np.flatnonzero(window)
+            index = np.zeros((size, size), dtype=np.int32)
+            core = labels[ty * size - top : (ty + 1) * size - top, tx * size - left : (tx + 1) * size - left]
+            index[: core.shape[0], : core.shape[1]] = label_to_index[core]
+            nearest = (top, left, right - left, index)
+
+        self._nearest_cache[key] = nearest
+        if len(self._nearest_cache) > self.cache_tiles:
+            self._nearest_cache.popitem(last=False)
+        return nearest
+
+
+class NavigationGrid:
+    NEIGHBOURS = np.array([(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)], dtype=np.int64)
+    CROSS_KERNEL = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+    SQUARE_KERNEL = np.ones((3, 3), dtype=np.uint8)
+
+    def __init__(self, tiles: TiledWalkableMask, cell_size: int = 8, cache_goals: int = 8):
+        if tiles.tile_size % cell_size:
+            raise ValueError(f"cell_size {cell_size} must divide the tile size {tiles.tile_size}")
+        self.cell_size = cell_size
+        self.rows = -(-tiles.height // cell_size)
+        self.cols = -(-tiles.width // cell_size)
+        self.walkable = self._coarsen(tiles)
+        self.interior = self._interior_directions(self.walkable)
+        self.cache_goals = cache_goals
+        self._goal_fields: "OrderedDict[Tuple[Tuple[int, int], ...], Tuple[np.ndarray, np.ndarray]]"
+        self._goal_fields = OrderedDict()
+
+    def _coarsen(self, tiles: TiledWalkableMask) -> np.ndarray:
+        per_tile = tiles.tile_size // self.cell_size
+        grid = np.zeros((tiles.tiles_y * per_tile, tiles.tiles_x * per_tile), dtype=np.bool_)
+        for ty in range(tiles.tiles_y):
+            for tx in range(tiles.tiles_x):
+                count = tiles.counts[ty, tx]
+                if count == 0:
+                    continue
+                block = grid[ty * per_tile : (ty + 1) * per_tile, tx * per_tile : (tx + 1) * per_tile]
+                if count == tiles.full_count:
+                    block[:] = True
+                    continue
+                cells = tiles.tile(ty, tx).reshape(per_tile, self.cell_size, per_tile, self.cell_size)
+                block[:] = cells.mean(axis=(1, 3)) >= 0.5
+        return grid[: self.rows, : self.cols].copy()
+
+    @staticmethod
+    def _interior_directions(walkable: np.ndarray) -> np.ndarray:
+        clearance = cv2.distanceTransform(walkable.astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_5)
+        gradient = np.dstack(
+            (cv2.Sobel(clearance, cv2.CV_32F, 1, 0, ksize=3), cv2.Sobel(clearance, cv2.CV_32F, 0, 1, ksize=3))
+        )
+        return NavigationGrid._normalise(gradient)
+
+    @staticmethod
+    def _normalise(vectors: np.ndarray) -> np.ndarray:
+        norm = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return np.divide(vectors, norm, out=np.zeros_like(vectors), where=norm > 1e-6)
+
+    def cells(self, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        rows = np.clip(positions[:, 1] // self.cell_size, 0, self.rows - 1).astype(np.int64)
+        cols = np.clip(positions[:, 0] // self.cell_size, 0, self.cols - 1).astype(np.int64)
+        return rows, cols
+
+    def interior_directions(self, positions: np.ndarray) -> np.ndarray:
+        return self.interior[self.cells(positions)]
+
+    def goal_key(self, goals: Sequence[Tuple[float, float]]) -> Tuple[Tuple[int, int], ...]:
+        seeds = self.cells(np.asarray(goals, dtype=np.float32).reshape(-1, 2))
+        return tuple(sorted(set(zip(seeds[0].tolist(), seeds[1].tolist()))))
+
+    def cached_goal_field(self, key: Tuple[Tuple[int, int], ...]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        cached = self._goal_fields.get(key)
+        if cached is not None:
+            self._goal_fields.move_to_end(key)
+        return cached
+
+    def store_goal_field(
+        self, key: Tuple[Tuple[int, int], ...], field: Tuple[np.ndarray, np.ndarray]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        self._goal_fields[key] = field
+        if len(self._goal_fields) > self.cache_goals:
+            self._goal_fields.popitem(last=False)
+        return field
+
+    def build_goal_field(self, key: Tuple[Tuple[int, int], ...]) -> Tuple[np.ndarray, np.ndarray]:
+        seeds = tuple(np.array(axis, dtype=np.int64) for axis in zip(*key))
+        distances = self._wavefront(seeds)
+        directions = self._descent_directions(distances)
+        self._extend_to_fringe(distances, directions)
+        return distances, directions
+
+    def goal_field(self, goals: Sequence[Tuple[float, float]]) -> Tuple[np.ndarray, np.ndarray]:
+        key = self.goal_key(goals)
+        cached = self.cached_goal_field(key)
+        if cached is not None:
+            return cached
+        return self.store_goal_field(key, self.build_goal_field(key))
+
+    def _wavefront(self, seeds: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+        # Alternating 4- and 8-neighbour dilations give an octagonal distance
+        # that is close enough to Euclidean for steering, at cv2.dilate speed.
+        distances = np.full((self.rows, self.cols), np.inf, dtype=np.float32)
+        distances[seeds] = 0.0
+        frontier = np.zeros((self.rows, self.cols), dtype=np.uint8)
+        frontier[seeds] = 1
+        unvisited = self.walkable.copy()
+        unvisited[seeds] = False
+        step = 0
+        while True:
+            step += 1
+            kernel = self.SQUARE_KERNEL if step % 2 else self.CROSS_KERNEL
+            grown = cv2.dilate(frontier, kernel).view(np.bool_) & unvisited
+            if not grown.any():
+                return distances
+            distances[grown] = step
+            unvisited &= ~grown
+            frontier = grown.view(np.uint8)
+
+    def _extend_to_fringe(self, distances: np.ndarray, directions: np.ndarray, reach: float = 2.5) -> None:
+        reached = np.isfinite(distances)
+        if reached.all() or not reached.any():
+            return
+        gap, labels = cv2.distanceTransformWithLabels(
+            (~reached).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_5, labelType=cv2.DIST_LABEL_PIXEL
+        )
+        label_to_index = np.zeros(int(labels.max()) + 1, dtype=np.int64)
+        label_to_index[labels[reached]] = np.flatnonzero(reached)
+        fringe = ~reached & (gap <= reach)
+        rows, cols = np.nonzero(fringe)
+        target_rows, target_cols = np.divmod(label_to_index[labels[fringe]], self.cols)
+        distances[fringe] = distances[target_rows, target_cols] + gap[fringe]
+        offsets = np.column_stack((target_cols - cols, target_rows - rows)).astype(np.float32)
+        directions[fringe] = self._normalise(offsets)
+
+    def _descent_directions(self, distances: np.ndarray) -> np.ndarray:
+        padded = np.pad(distances, 1, constant_values=np.inf)
+        neighbours = np.stack(
+            [padded[1 + dy : 1 + dy + self.rows, 1 + dx : 1 + dx + self.cols] for dy, dx in self.NEIGHBOURS]
+        )
+        best = np.argmin(neighbours, axis=0)
+        descending = np.take_along_axis(neighbours, best[None], axis=0)[0] < distances
+        offsets = self.NEIGHBOURS[best][..., ::-1].astype(np.float32)
+        directions = self._normalise(offsets) * descending[..., None]
+        smoothed = np.dstack([cv2.blur(directions[..., axis], (3, 3)) for axis in range(2)])
+        smoothed = self._normalise(smoothed) * descending[..., None]
+        return np.where(np.linalg.norm(smoothed, axis=-1, keepdims=True) > 0, smoothed, directions)
 
-    def _coords_with_margin(self, margin: int) -> np.ndarray:
-        if margin <= 0:
-            return self.walkable_coords
 
-        cached = self._margin_cache.get(margin)
-        if cached is not None and len(cached) > 0:
-            return cached
+def _dumps_stdlib(message: object) -> bytes:
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False).encode()
 
-        coords = self.walkable_coords
-        mask = (
-            (coords[:, 0] >= margin)
-            & (coords[:, 0] < self.height - margin)
-            & (coords[:, 1] >= margin)
-            & (coords[:, 1] < self.width - margin)
-        )
-        filtered = coords[mask]
-        if len(filtered) == 0:
-            self._margin_cache[margin] = self.walkable_coords
-            return self.walkable_coords
-
-        self._margin_cache[margin] = filtered
-        return filtered
-
-    def cluster_origin(self) -> Tuple[float, float]:
-        sample_size = min(500, len(self.walkable_coords))
-        sample_indices = np.random.choice(len(self.walkable_coords), size=sample_size, replace=False)
-        subset = self.walkable_coords[sample_indices]
-        mean_y, mean_x = subset.mean(axis=0)
-        return float(mean_x), float(mean_y)
 
-    def snap_to_walkable(self, x: float, y: float, max_radius: int = 80) -> Tuple[float, float]:
+def _dumps_orjson(message: object) -> bytes:
+    return orjson.dumps(message, option=orjson.OPT_SERIALIZE_NUMPY)
 
-        if self.is_walkable(x, y):
-            return float(x), float(y)
 
-        ix, iy = int(round(x)), int(round(y))
-        anchor = np.array([x, y], dtype=np.float32)
+JSON_ENCODERS: Dict[str, Callable[[object], bytes]] = {"json": _dumps_stdlib}
+if orjson is not None:
+    JSON_ENCODERS["orjson"] = _dumps_orjson
+dumps_json = JSON_ENCODERS.get(JSON_ENCODER, _dumps_stdlib)
+
+
+def render_metric(name: str, kind: str, help_text: str, value: float) -> List[str]:
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
 
-        for radius in range(4, max_radius + 1, 4):
-            min_x = max(ix - radius, 0)
-            max_x = min(ix + radius, self.width - 1)
-            min_y = max(iy - radius, 0)
-            max_y = min(iy + radius, self.height - 1)
 
-            region = self.walkable_mask[min_y : max_y + 1, min_x : max_x + 1]
-            coords = np.argwhere(region)
-            if coords.size == 0:
+_SAMPLE_PATTERN = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (.*)$")
+
+
+def _merge_labelled(sources: Sequence[Tuple[str, List[str]]], label: str) -> List[str]:
+    headers: "OrderedDict[str, List[str]]" = OrderedDict()
+    samples: Dict[str, List[str]] = {}
+    for value, lines in sources:
+        family = ""
+        for line in lines:
+            if line.startswith("# "):
+                family = line.split(" ", 3)[2]
+                family_headers = headers.setdefault(family, [])
+                if line not in family_headers:
+                    family_headers.append(line)
                 continue
+            match = _SAMPLE_PATTERN.match(line)
+            if match is None:
+                continue
+            name, labels, sample = match.groups()
+            labels = f'{label}="{value}",{labels}' if labels else f'{label}="{value}"'
+            headers.setdefault(family, [])
+            samples.setdefault(family, []).append(f"{name}{{{labels}}} {sample}")
+    return [line for family, lines in headers.items() for line in lines + samples.get(family, [])]
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def render(
+        self, name: str, help_text: str, labels: Optional[Dict[str, str]] = None, header: bool = True
+    ) -> List[str]:
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"] if header else []
+        label_text = "".join(f'{key}="{value}",' for key, value in (labels or {}).items())
+        series = f"{{{label_text[:-1]}}}" if label_text else ""
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label_text}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{label_text}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{series} {self.total}")
+        lines.append(f"{name}_count{series} {self.count}")
+        return lines
+
+
+class PhaseTimer:
+    PHASE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+    def __init__(self, phases: Sequence[str]):
+        self.phases = list(phases)
+        self.totals = dict.fromkeys(self.phases, 0.0)
+        self.last = dict.fromkeys(self.phases, 0.0)
+        self.histograms = {name: Histogram(self.PHASE_BUCKETS) for name in self.phases}
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.last[name] = elapsed
+            self.totals[name] += elapsed
+            self.histograms[name].observe(elapsed)
+
+    def reset(self) -> None:
+        self.totals = dict.fromkeys(self.phases, 0.0)
+
+    def render(self, name: str, help_text: str) -> List[str]:
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for phase, histogram in self.histograms.items():
+            lines += histogram.render(name, help_text, labels={"phase": phase}, header=False)
+        return lines
+
+
+class SocketMetrics:
+    SEND_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.open_connections = 0
+        self.accepted_connections = 0
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.send_seconds = Histogram(self.SEND_BUCKETS)
+        self.encode_seconds = Histogram(self.SEND_BUCKETS)
+
+    def connected(self) -> None:
+        self.open_connections += 1
+        self.accepted_connections += 1
+
+    def disconnected(self) -> None:
+        self.open_connections -= 1
+
+    async def send(self, websocket: WebSocket, payload: Union[bytes, str]) -> None:
+        started = time.perf_counter()
+        if isinstance(payload, bytes):
+            await websocket.send_bytes(payload)
+            size = len(payload)
+        else:
+            await websocket.send_text(payload)
+            size = len(payload) if payload.isascii() else len(payload.encode())
+        self.send_seconds.observe(time.perf_counter() - started)
+        self.messages_sent += 1
+        self.bytes_sent += size
+
+    async def send_json(self, websocket: WebSocket, message: Dict[str, object]) -> None:
+        await self.send(websocket, dumps_json(message).decode())
+
+    def render_metrics(self) -> List[str]:
+        prefix = f"ws_{self.endpoint}"
+        path = f"/ws/{self.endpoint}"
+        lines = render_metric(f"{prefix}_connections", "gauge", f"Open {path} connections.", self.open_connections)
+        lines += render_metric(
+            f"{prefix}_connections_total", "counter", f"{path} connections accepted.", self.accepted_connections
+        )
+        lines += render_metric(f"{prefix}_messages_sent_total", "counter", "Messages sent.", self.messages_sent)
+        lines += render_metric(f"{prefix}_bytes_sent_total", "counter", "Payload bytes sent.", self.bytes_sent)
+        lines += self.send_seconds.render(f"{prefix}_send_seconds", "Time spent awaiting a websocket send.")
+        lines += self.encode_seconds.render(f"{prefix}_encode_seconds", "Time spent serialising a payload.")
+        return lines
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.01, max_depth: int = 48):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+        self.thread_id: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._thread is not None
+
+    def start(self, thread_id: Optional[int] = None) -> None:
+        if self._thread is not None:
+            return
+        self.thread_id = thread_id or threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+        self._thread.start()
 
-            abs_coords = coords + np.array([min_y, min_x])
-            points = np.stack((abs_coords[:, 1], abs_coords[:, 0]), axis=1).astype(np.float32)
-            distances = np.sum((points - anchor) ** 2, axis=1)
-            best_idx = int(np.argmin(distances))
-            px, py = points[best_idx]
-            return float(px), float(py)
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def clear(self) -> None:
+        self.stacks = {}
+        self.samples = 0
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names: List[str] = []
+            while frame is not None and len(names) < self.max_depth:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if not names:
+                continue
+            stack = ";".join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
 
-        return self.random_walkable_point()
+    def collapsed(self) -> str:
+        ordered = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)
+        return "".join(f"{stack} {count}\n" for stack, count in ordered)
 
+    def render_metrics(self) -> List[str]:
+        lines = render_metric(
+            "profiler_enabled", "gauge", "Whether the sampling profiler is running.", int(self.enabled)
+        )
+        lines += render_metric("profiler_samples_total", "counter", "Stack samples collected.", self.samples)
+        return lines
+
+
+class SimulatedClock:
+    def __init__(self, start: float = 0.0):
+        self.now = start
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> float:
+        self.now += seconds
+        return self.now
+
+
+class FixedStepScheduler:
+    TICK_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.0333, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self, rate_hz: float = 30.0, max_substeps: int = 4, rate_window: int = 64):
+        self.rate_hz = rate_hz
+        self.dt = 1.0 / rate_hz
+        self.max_substeps = max_substeps
+        self.tick_durations = Histogram(self.TICK_BUCKETS)
+        self.ticks = 0
+        self.overruns = 0
+        self.catchup_substeps = 0
+        self.dropped_ticks = 0
+        self._tick_starts = np.zeros(rate_window, dtype=np.float64)
+
+    def achieved_hz(self) -> float:
+        window = min(self.ticks, len(self._tick_starts))
+        if window < 2:
+            return 0.0
+        newest = self._tick_starts[(self.ticks - 1) % len(self._tick_starts)]
+        oldest = self._tick_starts[(self.ticks - window) % len(self._tick_starts)]
+        if newest <= oldest:
+            return 0.0
+        return (window - 1) / (newest - oldest)
+
+    def _record(self, started: float, finished: float) -> None:
+        self._tick_starts[self.ticks % len(self._tick_starts)] = started
+        self.ticks += 1
+        duration = finished - started
+        self.tick_durations.observe(duration)
+        if duration > self.dt:
+            self.overruns += 1
+
+    async def run(self, step: Callable[[float, float], Awaitable[None]]) -> None:
+        wall_offset = time.time() - time.monotonic()
+        next_tick = time.monotonic()
+        while True:
+            substeps = 0
+            while time.monotonic() >= next_tick and substeps < self.max_substeps:
+                started = time.monotonic()
+                await step(wall_offset + next_tick, self.dt)
+                self._record(started, time.monotonic())
+                next_tick += self.dt
+                substeps += 1
+            self.catchup_substeps += max(0, substeps - 1)
+
+            behind = time.monotonic() - next_tick
+            if behind >= 0:
+                missed = int(behind // self.dt) + 1
+                self.dropped_ticks += missed
+                next_tick += missed * self.dt
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+
+    def render_metrics(self) -> List[str]:
+        lines = self.tick_durations.render("crowd_tick_duration_seconds", "Wall time spent per simulation tick.")
+        lines += render_metric("crowd_ticks_total", "counter", "Simulation ticks executed.", self.ticks)
+        lines += render_metric(
+            "crowd_tick_overruns_total", "counter", "Ticks that took longer than the tick budget.", self.overruns
+        )
+        lines += render_metric(
+            "crowd_tick_catchup_substeps_total", "counter", "Extra substeps run to catch up.", self.catchup_substeps
+        )
+        lines += render_metric(
+            "crowd_ticks_dropped_total", "counter", "Ticks skipped after catch-up ran out.", self.dropped_ticks
+        )
+        lines += render_metric("crowd_tick_target_hz", "gauge", "Configured simulation rate.", self.rate_hz)
+        lines += render_metric("crowd_tick_achieved_hz", "gauge", "Measured simulation rate.", self.achieved_hz())
+        return lines
+
+
+class SpatialHashGrid:
+    NEIGHBOUR_OFFSETS = tuple((dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1))
+
+    def __init__(self, cell_size: float):
+        self.cell_size = max(1.0, float(cell_size))
+        self.count = 0
+        self._keys = np.empty(0, dtype=np.int64)
+        self._order = np.empty(0, dtype=np.int64)
+        self._cell_starts = np.zeros(1, dtype=np.int64)
+        self._cell_counts = np.zeros(1, dtype=np.int64)
+        self._stride = 1
+        self._origin = np.zeros(2, dtype=np.int64)
+        self._positions = np.empty((0, 2), dtype=np.float32)
+        self._ranges: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    def rebuild(self, positions: np.ndarray) -> None:
+        self.count = len(positions)
+        self._ranges = None
+        if self.count == 0:
+            self._keys = self._order = np.empty(0, dtype=np.int64)
+            return
+        self._positions = positions
+        cells = np.floor(positions / self.cell_size).astype(np.int64)
+        self._origin = cells.min(axis=0) - 1
+        cells -= self._origin
+        self._stride = int(cells[:, 0].max()) + 2
+        rows = int(cells[:, 1].max()) + 2
+        self._keys = cells[:, 1] * self._stride + cells[:, 0]
+        self._order = np.argsort(self._keys, kind="stable")
+        self._cell_counts = np.bincount(self._keys, minlength=rows * self._stride)
+        self._cell_starts = np.cumsum(self._cell_counts) - self._cell_counts
+
+    def _neighbour_ranges(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._ranges is None:
+            neighbour_keys = np.stack([self._keys + dy * self._stride + dx for dx, dy in self.NEIGHBOUR_OFFSETS])
+            self._ranges = (self._cell_starts[neighbour_keys], self._cell_counts[neighbour_keys])
+        return self._ranges
+
+    def query_rect(self, x0: float, y0: float, x1: float, y1: float) -> np.ndarray:
+        if self.count == 0:
+            return np.empty(0, dtype=np.int64)
+        rows = len(self._cell_counts) // self._stride
+        low = np.floor(np.array([x0, y0]) / self.cell_size).astype(np.int64) - self._origin
+        high = np.floor(np.array([x1, y1]) / self.cell_size).astype(np.int64) - self._origin
+        low = np.maximum(low, 0)
+        high = np.minimum(high, (self._stride - 1, rows - 1))
+        if np.any(low > high):
+            return np.empty(0, dtype=np.int64)
+        first_keys = np.arange(low[1], high[1] + 1) * self._stride + low[0]
+        last_keys = first_keys + (high[0] - low[0])
+        starts = self._cell_starts[first_keys]
+        stops = self._cell_starts[last_keys] + self._cell_counts[last_keys]
+        candidates = np.concatenate([self._order[start:stop] for start, stop in zip(starts, stops)])
+        points = self._positions[candidates]
+        inside = (points[:, 0] >= x0) & (points[:, 0] <= x1) & (points[:, 1] >= y0) & (points[:, 1] <= y1)
+        return np.sort(candidates[inside])
+
+    def pair_count(self) -> int:
+        if self.count == 0:
+            return 0
+        return int(self._neighbour_ranges()[1].sum())
+
+    def neighbour_pairs(self, max_pairs: int = 1 << 20) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        if self.count == 0:
+            return
+        starts, counts = self._neighbour_ranges()
+        per_point = np.cumsum(counts.sum(axis=0))
+        bounds = np.searchsorted(per_point, np.arange(max_pairs, per_point[-1], max_pairs), side="right")
+        edges = np.unique(np.concatenate(([0], bounds, [self.count])))
+
+        for first, last in zip(edges[:-1], edges[1:]):
+            sources = []
+            targets = []
+            for offset in range(len(self.NEIGHBOUR_OFFSETS)):
+                span = counts[offset, first:last]
+                total = int(span.sum())
+                if total == 0:
+                    continue
+                inner = np.arange(total) - np.repeat(np.cumsum(span) - span, span)
+                sources.append(np.repeat(np.arange(first, last), span))
+                targets.append(self._order[np.repeat(starts[offset, first:last], span) + inner])
+            if sources:
+                yield np.concatenate(sources), np.concatenate(targets)
+
+
+class DensityGrid:
+
+    # Heatmap frame: 32-byte little-endian header (magic, version, channel, cell size, tick,
+    # timestamp, cols, rows, peak agents per cell) followed by rows * cols uint8 scaled to the peak.
+    MAGIC = b"CRHM"
+    VERSION = 1
+    FRAME_HEADER = struct.Struct("<4sBBHIdHHf4x")
+    ALL, LARGE = 0, 1
+    MAX_SCALE_EXPONENT = 16.0
+
+    def __init__(
+        self, width: int, height: int, cell_size: int = 8, half_life: float = 2.0, blur_sigma: float = 1.5
+    ):
+        self.width = width
+        self.height = height
+        self.cell_size = cell_size
+        self.half_life = half_life
+        self.blur_sigma = blur_sigma
+        self.cols = -(-width // cell_size)
+        self.rows = -(-height // cell_size)
+        self.grid = np.zeros((2, self.rows, self.cols), dtype=np.float32)
+        self._decay_rate = math.log(2.0) / half_life
+        self._elapsed = 0.0
+        self.last_hotspots: List[Dict[str, float]] = []
+        self._blurred: Dict[int, np.ndarray] = {}
+        self._peak_kernel = np.ones((5, 5), dtype=np.uint8)
+
+    def update(self, positions: np.ndarray, is_large: np.ndarray, dt: float) -> None:
+        # Decay is applied lazily: contributions are stored scaled up by exp(rate * elapsed)
+        # and the grid is only scaled back down when it is read or the scale grows too large.
+        self._elapsed += dt
+        if self._elapsed * self._decay_rate > self.MAX_SCALE_EXPONENT:
+            self._rebase()
+        weight = math.exp(self._elapsed * self._decay_rate) * (1.0 - 0.5 ** (dt / self.half_life))
+        if len(positions):
+            cols = np.clip(positions[:, 0] // self.cell_size, 0, self.cols - 1).astype(np.int64)
+            rows = np.clip(positions[:, 1] // self.cell_size, 0, self.rows - 1).astype(np.int64)
+            cells = rows * self.cols + cols
+            cells = np.concatenate((cells, cells[is_large] + self.LARGE * self.rows * self.cols))
+            touched, counts = np.unique(cells, return_counts=True)
+            self.grid.reshape(-1)[touched] += counts.astype(np.float32) * np.float32(weight)
+        self._blurred.clear()
+
+    def _rebase(self) -> None:
+        if self._elapsed == 0.0:
+            return
+        self.grid *= np.float32(math.exp(-self._elapsed * self._decay_rate))
+        self._elapsed = 0.0
+        np.putmask(self.grid, self.grid < 1e-4, 0.0)
+
+    def blurred(self, channel: int = ALL) -> np.ndarray:
+        blurred = self._blurred.get(channel)
+        if blurred is None:
+            self._rebase()
+            blurred = cv2.GaussianBlur(self.grid[channel], (0, 0), self.blur_sigma)
+            self._blurred[channel] = blurred
+        return blurred
+
+    def raster(self, cell_size: int, channel: int = ALL) -> Tuple[np.ndarray, float]:
+        density = self.blurred(channel)
+        factor = max(1, cell_size // self.cell_size)
+        if factor > 1:
+            size = (-(-self.cols // factor), -(-self.rows // factor))
+            density = cv2.resize(density, size, interpolation=cv2.INTER_AREA) * (factor * factor)
+        peak = float(density.max()) if density.size else 0.0
+        if peak <= 1e-6:
+            return np.zeros(density.shape, dtype=np.uint8), 0.0
+        return np.clip(density * (255.0 / peak), 0, 255).astype(np.uint8), peak
+
+    def encode(self, tick: int, timestamp: float, cell_size: int, channel: int = ALL) -> bytes:
+        raster, peak = self.raster(cell_size, channel)
+        effective_cell = self.cell_size * max(1, cell_size // self.cell_size)
+        header = self.FRAME_HEADER.pack(
+            self.MAGIC,
+            self.VERSION,
+            channel,
+            effective_cell,
+            tick & 0xFFFFFFFF,
+            timestamp,
+            raster.shape[1],
+            raster.shape[0],
+            peak,
+        )
+        return header + raster.tobytes()
+
+    def hotspots(self, count: int = 3, min_fraction: float = 0.25) -> List[Dict[str, float]]:
+        density = self.blurred(self.LARGE)
+        peak = float(density.max()) if density.size else 0.0
+        if peak <= 1e-3:
+            self.last_hotspots = []
+            return self.last_hotspots
+        maxima = (density >= cv2.dilate(density, self._peak_kernel)) & (density >= peak * min_fraction)
+        candidates = np.flatnonzero(maxima)
+        if candidates.size > count:
+            values = density.ravel()[candidates]
+            candidates = candidates[np.argpartition(values, -count)[-count:]]
+        candidates = candidates[np.argsort(density.ravel()[candidates])[::-1]]
+        rows, cols = np.divmod(candidates, self.cols)
+
+        padded = np.pad(density, 1)
+        offsets = np.arange(-1, 2)
+        window_rows = (rows[:, None, None] + 1 + offsets[None, :, None]).repeat(3, axis=2)
+        window_cols = (cols[:, None, None] + 1 + offsets[None, None, :]).repeat(3, axis=1)
+        windows = padded[window_rows, window_cols]
+        mass = windows.sum(axis=(1, 2))
+        centre_y = rows + (windows.sum(axis=2) * offsets).sum(axis=1) / mass
+        centre_x = cols + (windows.sum(axis=1) * offsets).sum(axis=1) / mass
+        self.last_hotspots = [
+            {"x": float((x + 0.5) * self.cell_size), "y": float((y + 0.5) * self.cell_size), "weight": float(weight)}
+            for x, y, weight in zip(centre_x, centre_y, density.ravel()[candidates] / peak)
+        ]
+        return self.last_hotspots
+
+
+class AgentArrays:
+
+    FIELDS = {
+        "ids": (np.int64, ()),
+        "positions": (np.float32, (2,)),
+        "headings": (np.float32, ()),
+        "speeds": (np.float32, ()),
+        "turn_rates": (np.float32, ()),
+        "is_large": (np.bool_, ()),
+        "last_unshrinked_at": (np.float64, ()),
+        "sigma_memory": (np.float32, (2,)),
+        "sigma_primed": (np.bool_, ()),
+    }
+
+    def __init__(self, capacity: int = 16):
+        self.count = 0
+        self.capacity = max(1, capacity)
+        self._storage: Dict[str, np.ndarray] = {
+            name: np.zeros((self.capacity, *shape), dtype=dtype) for name, (dtype, shape) in self.FIELDS.items()
+        }
 
-class Agent:
-    def __init__(self, agent_id: int, origin: Tuple[float, float], spawned_at: float):
-        offset_radius = random.uniform(8, 18)
-        angle = random.uniform(0, 2 * math.pi)
-        self.position = np.array(
-            [origin[0] + math.cos(angle) * offset_radius, origin[1] + math.sin(angle) * offset_radius],
-            dtype=np.float32,
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self._storage.values())
+
+    def __getattr__(self, name: str) -> np.ndarray:
+        storage = self.__dict__.get("_storage")
+        if storage is None or name not in storage:
+            raise AttributeError(name)
+        return storage[name][: self.count]
+
+    def clear(self) -> None:
+        self.count = 0
+
+    def allocate(self, amount: int) -> slice:
+        required = self.count + amount
+        if required > self.capacity:
+            new_capacity = max(required, self.capacity * 2)
+            for name, array in self._storage.items():
+                grown = np.zeros((new_capacity, *array.shape[1:]), dtype=array.dtype)
+                grown[: self.count] = array[: self.count]
+                self._storage[name] = grown
+            self.capacity = new_capacity
+        allocated = slice(self.count, required)
+        self.count = required
+        return allocated
+
+
+class MapFrame:
+    def __init__(
+        self,
+        tick: int,
+        timestamp: float,
+        ids: np.ndarray,
+        positions: np.ndarray,
+        is_large: np.ndarray,
+        last_unshrinked_at: np.ndarray,
+        fhu: Dict[str, object],
+        counts: Dict[str, int],
+    ):
+        self.tick = tick
+        self.timestamp = timestamp
+        self.ids = ids
+        self.positions = positions
+        self.is_large = is_large
+        self.last_unshrinked_at = last_unshrinked_at
+        self.fhu = fhu
+        self.counts = counts
+
+    def subset(self, indices: np.ndarray) -> "MapFrame":
+        return MapFrame(
+            self.tick,
+            self.timestamp,
+            self.ids[indices],
+            self.positions[indices],
+            self.is_large[indices],
+            self.last_unshrinked_at[indices],
+            self.fhu,
+            self.counts,
         )
-        self.agent_id = agent_id
-        self.speed = random.uniform(18, 35)
-        self.heading = random.uniform(0, 2 * math.pi)
-        self.turn_rate = random.uniform(0.5, 1.2)
-        self.is_large = False
-        self.last_unshrinked_at = spawned_at - random.uniform(0, 90)
-
-    def _proposed_step(self, dt: float) -> np.ndarray:
-        vx = math.cos(self.heading) * self.speed * dt
-        vy = math.sin(self.heading) * self.speed * dt
-        return self.position + np.array([vx, vy], dtype=np.float32)
-
-    def step(self, field: CollisionField, dt: float) -> None:
-        self.heading += random.uniform(-self.turn_rate, self.turn_rate) * dt
-        proposed = self._proposed_step(dt)
-        for _ in range(5):
-            if field.is_walkable(proposed[0], proposed[1]):
-                self.position = proposed
-                return
-            self.heading = random.uniform(0, 2 * math.pi)
-            proposed = self._proposed_step(dt)
 
-        self.position = np.array(field.snap_to_walkable(self.position[0], self.position[1]), dtype=np.float32)
+    def clusters(self, indices: np.ndarray, cell_size: float) -> List[Dict[str, float]]:
+        if len(indices) == 0:
+            return []
+        positions = self.positions[indices]
+        cells = np.floor(positions / cell_size).astype(np.int64)
+        keys = (cells[:, 1] << 32) + cells[:, 0]
+        _, groups, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        sum_x = np.bincount(groups, weights=positions[:, 0])
+        sum_y = np.bincount(groups, weights=positions[:, 1])
+        large = np.bincount(groups, weights=self.is_large[indices]).astype(np.int64)
+        return [
+            {"x": x, "y": y, "count": count, "large": large_count}
+            for x, y, count, large_count in zip(
+                (sum_x / counts).tolist(), (sum_y / counts).tolist(), counts.tolist(), large.tolist()
+            )
+        ]
+
+    def encode_state(self, width: int, height: int) -> bytes:
+        return dumps_json({"type": "state", **self.to_state(width, height)})
+
+    def to_state(self, width: int, height: int) -> Dict[str, object]:
+        return {
+            "timestamp": self.timestamp,
+            "people": [
+                {
+                    "id": agent_id,
+                    "x": x,
+                    "y": y,
+                    "state": "large" if is_large else "small",
+                    "last_unshrinked_at": last_unshrinked_at,
+                }
+                for agent_id, x, y, is_large, last_unshrinked_at in zip(
+                    self.ids.tolist(),
+                    self.positions[:, 0].tolist(),
+                    self.positions[:, 1].tolist(),
+                    self.is_large.tolist(),
+                    self.last_unshrinked_at.tolist(),
+                )
+            ],
+            "fhu": self.fhu,
+            "map": {"width": width, "height": height},
+            "counts": self.counts,
+        }
 
 
 class Crowd:
-    def __init__(self, field: CollisionField):
+    PHASES = ("commands", "step", "sigma", "events", "spawn", "density", "fhu", "snapshot")
+    MAX_GOALS = 16
+
+    def __init__(
+        self,
+        field: CollisionField,
+        max_agents: int = 10,
+        crowd_size: Optional[int] = None,
+        seed: Optional[int] = None,
+        clock: Callable[[], float] = time.time,
+    ):
         self.field = field
-        self.people: List[Agent] = []
+        self.clock = clock
+        self.phases = PhaseTimer(self.PHASES)
+        self.agents = AgentArrays(capacity=max(16, max_agents))
         self.lock = asyncio.Lock()
-        self.update_task: Optional[asyncio.Task] = None
         self.max_unshrink_interval = 300.0
         self.min_event_interval = 6.0
         self.max_event_interval = 14.0
@@ -178,190 +1151,377 @@ class Crowd:
         self.min_random_shrink_interval = 8.0
         self.max_random_shrink_interval = 20.0
         self.next_shrink_event = 0.0
-        self.max_agents = 10
+        self.max_agents = max_agents
+        self.crowd_size = crowd_size
+        self.goals: Optional[List[Tuple[float, float]]] = None
+        self._goal_directions: Optional[np.ndarray] = None
+        self._goals_version = 0
+        self.goal_steering = 4.0
+        self.wander_jitter = 0.5
         self.next_agent_id = 0
-        self._sigma_memory: Dict[int, np.ndarray] = {}
+        self.tick_count = 0
+        self.commands_received = 0
+        self.commands_applied = 0
+        self._index: Dict[int, int] = {}
+        self._pending_moves: Dict[int, Tuple[float, float]] = {}
+        self._pending_states: Dict[int, Union[str, bool]] = {}
+        self._rng = np.random.default_rng(seed)
         self._smoothing_alpha = 0.22
         self._cohesion_sigma = 60.0
-        self._last_state: Dict[str, object] = {
-            "timestamp": time.time(),
-            "people": [],
-            "fhu": {"x": 0.0, "y": 0.0, "confidence": 0.0},
-            "map": {"width": self.field.width, "height": self.field.height},
-            "counts": {"small": 0, "large": 0},
-        }
+        self._cohesion_cutoff = 3.0
+        self._cohesion_pair_budget = 1 << 18
+        self._cohesion_cell_fraction = 0.25
+        self._cohesion_grid = SpatialHashGrid(self._cohesion_cutoff * self._cohesion_sigma)
+        self.density = DensityGrid(field.width, field.height)
+        self._last_frame = self._capture_frame(
+            self.clock(), {"x": 0.0, "y": 0.0, "confidence": 0.0}, {"small": 0, "large": 0}
+        )
+        self._encoded_state: Tuple[Optional[int], bytes] = (None, b"")
         self._spawn_agents()
 
     def _spawn_agents(self) -> None:
-        crowd_size = random.randint(5, 7)
-        center = self.field.cluster_origin()
-        now = time.time()
-        spawned: List[Agent] = []
-        for _ in range(crowd_size):
-            jitter_x = center[0] + random.uniform(-40.0, 40.0)
-            jitter_y = center[1] + random.uniform(-40.0, 40.0)
-            snapped = self.field.snap_to_walkable(jitter_x, jitter_y)
-            spawned.append(self._create_agent(snapped, now))
-        self.people = spawned
+        crowd_size = self.crowd_size if self.crowd_size is not None else int(self._rng.integers(5, 8))
+        center = self.field.cluster_origin(rng=self._rng)
+        now = self.clock()
+        jitter = self._rng.uniform(-40.0, 40.0, size=(crowd_size, 2)) + np.array(center)
+        self.agents.clear()
+        self._index.clear()
+        self._pending_moves.clear()
+        self._pending_states.clear()
+        self._create_agents(self.field.snap_many(jitter, rng=self._rng), now)
         self.next_unshrink_event = now
         self._schedule_next_shrink(now)
 
-    def _create_agent(self, origin: Tuple[float, float], timestamp: float) -> Agent:
-        agent = Agent(self.next_agent_id, origin, timestamp)
-        self.next_agent_id += 1
-        return agent
+    def _create_agents(self, origins: np.ndarray, timestamp: float) -> slice:
+        count = len(origins)
+        created = self.agents.allocate(count)
+        agents = self.agents
+        offset_radius = self._rng.uniform(8, 18, size=count)
+        angle = self._rng.uniform(0, 2 * math.pi, size=count)
+        offsets = np.column_stack((np.cos(angle) * offset_radius, np.sin(angle) * offset_radius))
+        agents.ids[created] = np.arange(self.next_agent_id, self.next_agent_id + count)
+        agents.positions[created] = origins + offsets
+        agents.speeds[created] = self._rng.uniform(18, 35, size=count)
+        agents.headings[created] = self._rng.uniform(0, 2 * math.pi, size=count)
+        agents.turn_rates[created] = self._rng.uniform(0.5, 1.2, size=count)
+        agents.is_large[created] = False
+        agents.last_unshrinked_at[created] = timestamp - self._rng.uniform(0, 90, size=count)
+        agents.sigma_primed[created] = False
+        new_ids = range(self.next_agent_id, self.next_agent_id + count)
+        self._index.update(zip(new_ids, range(created.start, created.stop)))
+        self.next_agent_id += count
+        return created
 
     def _schedule_next_shrink(self, now: float) -> None:
-        self.next_shrink_event = now + random.uniform(self.min_random_shrink_interval, self.max_random_shrink_interval)
+        self.next_shrink_event = now + self._rng.uniform(
+            self.min_random_shrink_interval, self.max_random_shrink_interval
+        )
 
-    def _find_person(self, person_id: int) -> Optional[Agent]:
-        for person in self.people:
-            if person.agent_id == person_id:
-                return person
-        return None
+    def _find_person(self, person_id: int) -> Optional[int]:
+        return self._index.get(person_id)
+
+    def _apply_moves(self, moves: Dict[int, Tuple[float, float]]) -> int:
+        indices: List[int] = []
+        targets: List[Tuple[float, float]] = []
+        for person_id, target in moves.items():
+            index = self._index.get(person_id)
+            if index is not None and math.isfinite(target[0]) and math.isfinite(target[1]):
+                indices.append(index)
+                targets.append(target)
+        if not indices:
+            return 0
+        points = np.array(targets, dtype=np.float32)
+        np.clip(points[:, 0], 0, self.field.width - 1, out=points[:, 0])
+        np.clip(points[:, 1], 0, self.field.height - 1, out=points[:, 1])
+        self.agents.positions[indices] = self.field.snap_many(points, rng=self._rng)
+        return len(indices)
+
+    def queue_move(self, person_id: int, x: float, y: float) -> bool:
+        self.commands_received += 1
+        self._pending_moves[person_id] = (x, y)
+        return person_id in self._index
+
+    def _fold_state(self, person_id: int, desired_state: Optional[str]) -> None:
+        if desired_state in ("large", "small"):
+            self._pending_states[person_id] = desired_state
+            return
+        pending = self._pending_states.get(person_id, False)
+        if pending == "large":
+            self._pending_states[person_id] = "small"
+        elif pending == "small":
+            self._pending_states[person_id] = "large"
+        else:
+            self._pending_states[person_id] = not pending
+
+    def queue_state(self, person_id: int, desired_state: Optional[str] = None) -> bool:
+        self.commands_received += 1
+        self._fold_state(person_id, desired_state)
+        return person_id in self._index
+
+    def queue_batch(
+        self, moves: Sequence[Tuple[int, float, float]], toggles: Sequence[Tuple[int, Optional[str]]]
+    ) -> int:
+        self.commands_received += len(moves) + len(toggles)
+        for person_id, x, y in moves:
+            self._pending_moves[person_id] = (x, y)
+        for person_id, desired_state in toggles:
+            self._fold_state(person_id, desired_state)
+        return len(moves) + len(toggles)
+
+    def _drain_commands(self) -> None:
+        if self._pending_moves:
+            moves, self._pending_moves = self._pending_moves, {}
+            self.commands_applied += self._apply_moves(moves)
+        if self._pending_states:
+            states, self._pending_states = self._pending_states, {}
+            self.commands_applied += sum(
+                self.set_state(person_id, state if isinstance(state, str) else None)
+                for person_id, state in states.items()
+                if state is not False
+            )
 
-    async def apply_move(self, person_id: int, x: float, y: float) -> bool:
-        async with self.lock:
-            person = self._find_person(person_id)
-            if person is None:
-                return False
-            clamped_x = float(np.clip(x, 0, self.field.width - 1))
-            clamped_y = float(np.clip(y, 0, self.field.height - 1))
-            if not self.field.is_walkable(clamped_x, clamped_y):
-                clamped_x, clamped_y = self.field.snap_to_walkable(clamped_x, clamped_y)
-            person.position = np.array([clamped_x, clamped_y], dtype=np.float32)
+    def set_state(self, person_id: int, desired_state: Optional[str] = None) -> bool:
+        index = self._find_person(person_id)
+        if index is None:
+            return False
+        if desired_state in {"large", "small"}:
+            make_large = desired_state == "large"
+        else:
+            make_large = not self.agents.is_large[index]
+        now = self.clock()
+        if make_large:
+            self._promote(index, now)
+        else:
+            self.agents.is_large[index] = False
+            self._schedule_next_shrink(now)
+        return True
+
+    def _snap_goals(self, goals: Optional[Sequence[Tuple[float, float]]]) -> Optional[List[Tuple[float, float]]]:
+        if not goals:
+            return None
+        points = np.asarray(list(goals)[: self.MAX_GOALS], dtype=np.float32).reshape(-1, 2)
+        points = points[np.isfinite(points).all(axis=1)]
+        if len(points) == 0:
+            return None
+        return [(float(x), float(y)) for x, y in self.field.snap_many(points, rng=self._rng).tolist()]
+
+    def _install_goals(self, goals: Optional[List[Tuple[float, float]]], directions: Optional[np.ndarray]) -> None:
+        self._goals_version += 1
+        self.goals = goals
+        self._goal_directions = directions
+
+    def set_goals(self, goals: Optional[Sequence[Tuple[float, float]]]) -> bool:
+        snapped = self._snap_goals(goals)
+        if snapped is None:
+            self._install_goals(None, None)
+            return True
+        self._install_goals(snapped, self.field.navigation().goal_field(snapped)[1])
+        return True
+
+    def handle_command(self, command: Tuple) -> bool:
+        action = command[0]
+        if action == "move":
+            return self.queue_move(*command[1:])
+        if action == "toggle":
+            return self.queue_state(*command[1:])
+        if action == "batch":
+            return self.queue_batch(*command[1:]) > 0
+        if action == "goals":
+            return self.set_goals(command[1])
+        if action == "reset":
+            self._spawn_agents()
             return True
+        return False
+
+    async def apply_move(self, person_id: int, x: float, y: float) -> bool:
+        return self.queue_move(person_id, x, y)
 
     async def toggle_state(self, person_id: int, desired_state: Optional[str] = None) -> bool:
-        async with self.lock:
-            person = self._find_person(person_id)
-            if person is None:
-                return False
-            if desired_state in {"large", "small"}:
-                make_large = desired_state == "large"
-            else:
-                make_large = not person.is_large
-            now = time.time()
-            if make_large:
-                person.is_large = True
-                person.last_unshrinked_at = now
-                self.next_unshrink_event = now + random.uniform(self.min_event_interval, self.max_event_interval)
-            else:
-                person.is_large = False
-                self._schedule_next_shrink(now)
+        return self.queue_state(person_id, desired_state)
+
+    async def apply_batch(
+        self, moves: Sequence[Tuple[int, float, float]], toggles: Sequence[Tuple[int, Optional[str]]]
+    ) -> int:
+        return self.queue_batch(moves, toggles)
+
+    async def apply_goals(self, goals: Optional[Sequence[Tuple[float, float]]]) -> bool:
+        snapped = self._snap_goals(goals)
+        if snapped is None:
+            self._install_goals(None, None)
             return True
+        version = self._goals_version
+        loop = asyncio.get_running_loop()
+        navigation = await loop.run_in_executor(None, self.field.navigation)
+        key = navigation.goal_key(snapped)
+        field = navigation.cached_goal_field(key)
+        if field is None:
+            built = await loop.run_in_executor(None, navigation.build_goal_field, key)
+            field = navigation.store_goal_field(key, built)
+        if version != self._goals_version:
+            return False
+        self._install_goals(snapped, field[1])
+        return True
+
+    def tick(self, current_time: float, dt: float) -> None:
+        self.tick_count += 1
+        phases = self.phases
+        with phases.phase("commands"):
+            self._drain_commands()
+        with phases.phase("step"):
+            self._step_agents(dt)
+        with phases.phase("sigma"):
+            self._apply_sigma_wave()
+        with phases.phase("events"):
+            self._update_unshrink_states(current_time)
+            self._maybe_random_shrink(current_time)
+        with phases.phase("spawn"):
+            self._maybe_spawn_small_agents(current_time)
+        with phases.phase("density"):
+            self.density.update(self.agents.positions, self.agents.is_large, dt)
+        with phases.phase("fhu"):
+            tracker_payload: Dict[str, object] = self._compute_fhu_estimate()
+            tracker_payload["hotspots"] = self.density.last_hotspots
+
+        with phases.phase("snapshot"):
+            large_count = int(np.count_nonzero(self.agents.is_large))
+            small_count = len(self.agents) - large_count
+            counts = {"large": large_count, "small": small_count}
+            self._last_frame = self._capture_frame(current_time, tracker_payload, counts)
+
+    def _capture_frame(self, timestamp: float, fhu: Dict[str, object], counts: Dict[str, int]) -> MapFrame:
+        agents = self.agents
+        return MapFrame(
+            self.tick_count,
+            timestamp,
+            agents.ids.copy(),
+            agents.positions.copy(),
+            agents.is_large.copy(),
+            agents.last_unshrinked_at.copy(),
+            fhu,
+            counts,
+        )
 
-    async def start(self) -> None:
-        if self.update_task is None:
-            self.update_task = asyncio.create_task(self._run())
+    def _step_vectors(self, indices: np.ndarray, dt: float) -> np.ndarray:
+        headings = self.agents.headings[indices]
+        distance = self.agents.speeds[indices] * dt
+        return np.column_stack((np.cos(headings) * distance, np.sin(headings) * distance))
 
-    async def stop(self) -> None:
-        if self.update_task:
-            self.update_task.cancel()
-            try:
-                await self.update_task
-            except asyncio.CancelledError:
-                pass
-            self.update_task = None
+    def _step_agents(self, dt: float) -> None:
+        agents = self.agents
+        count = len(agents)
+        if count == 0:
+            return
+        positions = agents.positions
+        headings = agents.headings
+        navigation = self.field.navigation()
+        headings += self._rng.uniform(-1.0, 1.0, size=count).astype(np.float32) * agents.turn_rates * dt
+        if self._goal_directions is not None:
+            desired = self._goal_directions[navigation.cells(positions)]
+            steering = np.any(desired != 0, axis=1)
+            turn = np.arctan2(desired[steering, 1], desired[steering, 0]) - headings[steering]
+            turn = (turn + math.pi) % (2 * math.pi) - math.pi
+            headings[steering] += turn * min(1.0, self.goal_steering * dt)
+
+        everyone = np.arange(count)
+        proposed = positions + self._step_vectors(everyone, dt)
+        walkable = self.field.are_walkable(proposed)
+        positions[walkable] = proposed[walkable]
+        blocked = everyone[~walkable]
+        if blocked.size == 0:
+            return
 
-    async def _run(self) -> None:
-        dt = 1.0 / 30.0
-        while True:
-            async with self.lock:
-                current_time = time.time()
-                for person in self.people:
-                    person.step(self.field, dt)
-                    self._apply_sigma_wave(person)
-                self._update_unshrink_states(current_time)
-                self._maybe_random_shrink(current_time)
-                self._maybe_spawn_small_agents(current_time)
-
-                tracker_payload = self._compute_fhu_estimate()
-                large_count = sum(1 for p in self.people if p.is_large)
-                small_count = len(self.people) - large_count
-                self._last_state = {
-                    "timestamp": current_time,
-                    "people": [
-                        {
-                            "id": person.agent_id,
-                            "x": float(person.position[0]),
-                            "y": float(person.position[1]),
-                            "state": "large" if person.is_large else "small",
-                            "last_unshrinked_at": person.last_unshrinked_at,
-                        }
-                        for person in self.people
-                    ],
-                    "fhu": tracker_payload,
-                    "map": {"width": self.field.width, "height": self.field.height},
-                    "counts": {"large": large_count, "small": small_count},
-                }
-            await asyncio.sleep(dt)
+        away = navigation.interior_directions(positions[blocked])
+        clear = np.any(away != 0, axis=1)
+        turned = np.where(clear, np.arctan2(away[:, 1], away[:, 0]), headings[blocked] + math.pi)
+        jitter = self._rng.uniform(-self.wander_jitter, self.wander_jitter, size=blocked.size)
+        headings[blocked] = turned + jitter
+        proposed = positions[blocked] + self._step_vectors(blocked, dt)
+        walkable = self.field.are_walkable(proposed)
+        positions[blocked[walkable]] = proposed[walkable]
+        stuck = blocked[~walkable]
+        positions[stuck] = self.field.snap_many(positions[stuck], rng=self._rng)
+
+    def _promote(self, index: int, now: float) -> None:
+        self.agents.is_large[index] = True
+        self.agents.last_unshrinked_at[index] = now
+        self.next_unshrink_event = now + self._rng.uniform(self.min_event_interval, self.max_event_interval)
 
     def _update_unshrink_states(self, now: float) -> None:
-        candidates = [agent for agent in self.people if not agent.is_large]
-        tardy_agents = [agent for agent in candidates if now - agent.last_unshrinked_at >= self.max_unshrink_interval]
-
-        def promote(target: Agent) -> None:
-            target.is_large = True
-            target.last_unshrinked_at = now
-            self.next_unshrink_event = now + random.uniform(self.min_event_interval, self.max_event_interval)
+        candidates = np.flatnonzero(~self.agents.is_large)
+        tardy_agents = candidates[now - self.agents.last_unshrinked_at[candidates] >= self.max_unshrink_interval]
 
-        if tardy_agents:
-            promote(random.choice(tardy_agents))
+        if tardy_agents.size:
+            self._promote(int(self._rng.choice(tardy_agents)), now)
             return
 
-        if candidates and now >= self.next_unshrink_event:
-            promote(random.choice(candidates))
+        if candidates.size and now >= self.next_unshrink_event:
+            self._promote(int(self._rng.choice(candidates)), now)
 
     def _maybe_random_shrink(self, now: float) -> None:
-        large_agents = [agent for agent in self.people if agent.is_large]
-        if not large_agents:
+        large_agents = np.flatnonzero(self.agents.is_large)
+        if large_agents.size == 0:
             self._schedule_next_shrink(now)
             return
         if now >= self.next_shrink_event:
-            victim = random.choice(large_agents)
-            victim.is_large = False
+            self.agents.is_large[self._rng.choice(large_agents)] = False
             self._schedule_next_shrink(now)
 
     def _maybe_spawn_small_agents(self, now: float) -> None:
-        large_count = sum(1 for agent in self.people if agent.is_large)
-        small_count = len(self.people) - large_count
+        large_count = int(np.count_nonzero(self.agents.is_large))
+        small_count = len(self.agents) - large_count
         if small_count >= large_count:
             return
 
-        available_slots = self.max_agents - len(self.people)
+        available_slots = self.max_agents - len(self.agents)
         if available_slots <= 0:
             return
 
         deficit = min(large_count - small_count, available_slots)
-        for _ in range(deficit):
-            spawn_origin = self.field.random_walkable_point(margin=CollisionField.DEFAULT_SPAWN_MARGIN)
-            snapped = self.field.snap_to_walkable(*spawn_origin)
-            new_agent = self._create_agent(snapped, now)
-            new_agent.last_unshrinked_at = now - random.uniform(10, 60)
-            self.people.append(new_agent)
-            self._sigma_memory[new_agent.agent_id] = new_agent.position.copy()
-
-    async def snapshot(self) -> Dict[str, object]:
-        async with self.lock:
-            return dict(self._last_state)
+        origins = self.field.random_walkable_points(
+            deficit, margin=CollisionField.DEFAULT_SPAWN_MARGIN, rng=self._rng
+        )
+        created = self._create_agents(origins, now)
+        self.agents.last_unshrinked_at[created] = now - self._rng.uniform(10, 60, size=deficit)
+        self.agents.sigma_memory[created] = self.agents.positions[created]
+        self.agents.sigma_primed[created] = True
+
+    def encoded_state(self) -> bytes:
+        frame = self._last_frame
+        tick, encoded = self._encoded_state
+        if tick != frame.tick:
+            encoded = frame.encode_state(self.field.width, self.field.height)
+            self._encoded_state = (frame.tick, encoded)
+        return encoded
+
+    async def latest(self) -> MapFrame:
+        return self._last_frame
 
     async def reset(self) -> None:
         async with self.lock:
             self._spawn_agents()
-            self._sigma_memory.clear()
+
+    def render_metrics(self) -> List[str]:
+        lines = self.phases.render("crowd_tick_phase_seconds", "Wall time spent per simulation tick phase.")
+        lines += render_metric("crowd_agents", "gauge", "Agents currently simulated.", len(self.agents))
+        lines += render_metric(
+            "crowd_commands_received_total", "counter", "Move/toggle commands queued.", self.commands_received
+        )
+        lines += render_metric(
+            "crowd_commands_applied_total", "counter", "Commands applied after coalescing.", self.commands_applied
+        )
+        return lines
 
     def _compute_fhu_estimate(self) -> Dict[str, float]:
-        large_agents = [agent for agent in self.people if agent.is_large]
-        if large_agents:
-            positions = np.stack([agent.position for agent in large_agents])
+        agents = self.agents
+        if np.any(agents.is_large):
+            positions = agents.positions[agents.is_large]
             weights = self._gaussian_cohesion_weights(positions)
             if np.count_nonzero(weights) == 0:
                 centroid = positions.mean(axis=0)
             else:
                 centroid = np.average(positions, axis=0, weights=weights)
             density = float(np.clip(weights.mean() / max(weights.max(), 1e-3), 0.05, 1.0))
-            size_factor = len(large_agents) / max(1, len(self.people))
+            size_factor = len(positions) / max(1, len(agents))
             confidence = float(np.clip(density * size_factor, 0.05, 0.99))
             return {
                 "x": float(centroid[0]),
@@ -369,160 +1529,1952 @@ class Crowd:
                 "confidence": float(confidence),
             }
 
-        if not self.people:
+        if len(agents) == 0:
             return {"x": 0.0, "y": 0.0, "confidence": 0.0}
 
-        fallback_positions = np.stack([agent.position for agent in self.people])
-        centroid = fallback_positions.mean(axis=0)
+        centroid = agents.positions.mean(axis=0)
         return {
             "x": float(centroid[0]),
             "y": float(centroid[1]),
             "confidence": 0.1,
         }
 
-    def _apply_sigma_wave(self, person: Agent) -> None:
-        previous = self._sigma_memory.get(person.agent_id)
-        if previous is None:
-            smoothed = person.position.copy()
-        else:
-            smoothed = self._smoothing_alpha * person.position + (1 - self._smoothing_alpha) * previous
-        person.position = smoothed
-        self._sigma_memory[person.agent_id] = smoothed.copy()
+    def _apply_sigma_wave(self) -> None:
+        agents = self.agents
+        primed = agents.sigma_primed
+        positions = agents.positions
+        positions[primed] = (
+            self._smoothing_alpha * positions[primed] + (1 - self._smoothing_alpha) * agents.sigma_memory[primed]
+        )
+        agents.sigma_memory[:] = positions
+        primed[:] = True
 
     def _gaussian_cohesion_weights(self, positions: np.ndarray) -> np.ndarray:
         if len(positions) <= 1:
             return np.ones(len(positions), dtype=np.float32)
 
-        diffs = positions[:, None, :] - positions[None, :, :]
-        dist_sq = np.sum(diffs ** 2, axis=2)
         sigma_sq = max(1.0, self._cohesion_sigma ** 2)
-        kernel = np.exp(-dist_sq / (2.0 * sigma_sq))
-        weights = kernel.sum(axis=1)
+        cutoff_sq = (self._cohesion_cutoff ** 2) * sigma_sq
+        grid = self._cohesion_grid
+        grid.rebuild(positions)
+        if grid.pair_count() > self._cohesion_pair_budget:
+            return self._binned_cohesion_weights(positions)
+        weights = np.zeros(len(positions), dtype=np.float64)
+        for sources, targets in grid.neighbour_pairs():
+            dist_sq = np.sum((positions[sources] - positions[targets]) ** 2, axis=1)
+            close = dist_sq <= cutoff_sq
+            kernel = np.exp(-dist_sq[close] / (2.0 * sigma_sq))
+            weights += np.bincount(sources[close], weights=kernel, minlength=len(positions))
         return weights.astype(np.float32)
 
+    def _binned_cohesion_weights(self, positions: np.ndarray) -> np.ndarray:
+        sigma = max(1.0, self._cohesion_sigma)
+        cell = sigma * self._cohesion_cell_fraction
+        padding = int(math.ceil(4.0 / self._cohesion_cell_fraction))
+        scaled = (positions - positions.min(axis=0)) / cell + padding
+        corner = np.floor(scaled).astype(np.int64)
+        frac = (scaled - corner).astype(np.float32)
+        rows = int(corner[:, 1].max()) + padding + 2
+        cols = int(corner[:, 0].max()) + padding + 2
+        flat = corner[:, 1] * cols + corner[:, 0]
+        corners = [
+            (dy * cols + dx, (frac[:, 0] if dx else 1 - frac[:, 0]) * (frac[:, 1] if dy else 1 - frac[:, 1]))
+            for dy in (0, 1)
+            for dx in (0, 1)
+        ]
+
+        grid = np.zeros(rows * cols, dtype=np.float32)
+        for shift, share in corners:
+            grid += np.bincount(flat + shift, weights=share, minlength=rows * cols).astype(np.float32)
+        spread = sigma / cell
+        blurred = cv2.GaussianBlur(grid.reshape(rows, cols), (0, 0), spread, borderType=cv2.BORDER_CONSTANT)
+        blurred = blurred.ravel() * (2.0 * math.pi * spread * spread)
+
+        weights = np.zeros(len(positions), dtype=np.float32)
+        for shift, share in corners:
+            weights += share * blurred[flat + shift]
+        return weights
+
+
+class SharedFrameBuffer:
+    HEADER = struct.Struct("<QQdfffIII4x")
+    METRICS_HEADER = struct.Struct("<QQ")
+    METRICS_BYTES = 32768
+    ROW_BYTES = 8 + 8 + 8 + 1
+
+    def __init__(self, capacity: int, name: Optional[str] = None):
+        self.capacity = capacity
+        self._metrics_offset = self.HEADER.size + capacity * self.ROW_BYTES
+        size = self._metrics_offset + self.METRICS_HEADER.size + self.METRICS_BYTES
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.name = self.shm.name
+        self._sequence = 0
+        self._metrics_sequence = 0
+        offset = self.HEADER.size
+        self._ids = np.ndarray((capacity,), dtype=np.int64, buffer=self.shm.buf, offset=offset)
+        offset += capacity * 8
+        self._positions = np.ndarray((capacity, 2), dtype=np.float32, buffer=self.shm.buf, offset=offset)
+        offset += capacity * 8
+        self._last_unshrinked_at = np.ndarray((capacity,), dtype=np.float64, buffer=self.shm.buf, offset=offset)
+        offset += capacity * 8
+        self._is_large = np.ndarray((capacity,), dtype=np.bool_, buffer=self.shm.buf, offset=offset)
+
+    def write(self, frame: MapFrame) -> None:
+        count = min(len(frame.ids), self.capacity)
+        self._sequence += 1
+        struct.pack_into("<Q", self.shm.buf, 0, self._sequence)
+        self._ids[:count] = frame.ids[:count]
+        self._positions[:count] = frame.positions[:count]
+        self._last_unshrinked_at[:count] = frame.last_unshrinked_at[:count]
+        self._is_large[:count] = frame.is_large[:count]
+        self._sequence += 1
+        self.HEADER.pack_into(
+            self.shm.buf,
+            0,
+            self._sequence,
+            frame.tick,
+            frame.timestamp,
+            frame.fhu["x"],
+            frame.fhu["y"],
+            frame.fhu["confidence"],
+            frame.counts["large"],
+            frame.counts["small"],
+            count,
+        )
 
-collision_field = CollisionField(MAP_PATH)
-simulation = Crowd(collision_field)
+    def read(self, retries: int = 8) -> Optional[MapFrame]:
+        for _ in range(retries):
+            sequence, tick, timestamp, fhu_x, fhu_y, confidence, large, small, count = self.HEADER.unpack_from(
+                self.shm.buf
+            )
+            if sequence == 0 or sequence % 2:
+                continue
+            frame = MapFrame(
+                tick,
+                timestamp,
+                self._ids[:count].copy(),
+                self._positions[:count].copy(),
+                self._is_large[:count].copy(),
+                self._last_unshrinked_at[:count].copy(),
+                {"x": fhu_x, "y": fhu_y, "confidence": confidence},
+                {"large": large, "small": small},
+            )
+            if struct.unpack_from("<Q", self.shm.buf)[0] == sequence:
+                return frame
+        return None
+
+    def write_metrics(self, lines: List[str]) -> None:
+        encoded = "\n".join(lines).encode()[: self.METRICS_BYTES]
+        start = self._metrics_offset + self.METRICS_HEADER.size
+        self._metrics_sequence += 1
+        self.METRICS_HEADER.pack_into(self.shm.buf, self._metrics_offset, self._metrics_sequence, 0)
+        self.shm.buf[start : start + len(encoded)] = encoded
+        self._metrics_sequence += 1
+        self.METRICS_HEADER.pack_into(self.shm.buf, self._metrics_offset, self._metrics_sequence, len(encoded))
+
+    def read_metrics(self, retries: int = 8) -> List[str]:
+        start = self._metrics_offset + self.METRICS_HEADER.size
+        for _ in range(retries):
+            sequence, length = self.METRICS_HEADER.unpack_from(self.shm.buf, self._metrics_offset)
+            if sequence == 0 or sequence % 2:
+                continue
+            encoded = bytes(self.shm.buf[start : start + length])
+            if self.METRICS_HEADER.unpack_from(self.shm.buf, self._metrics_offset)[0] == sequence:
+                return encoded.decode().split("\n") if encoded else []
+        return []
+
+    def close(self, unlink: bool = False) -> None:
+        del self._ids, self._positions, self._last_unshrinked_at, self._is_large
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class CrowdProcess:
+    def __init__(self, field: CollisionField, max_agents: int = 10, crowd_size: Optional[int] = None):
+        self.field = field
+        self.max_agents = max_agents
+        self.crowd_size = crowd_size
+        self.capacity = max(max_agents, crowd_size or 7)
+        self.frames: Optional[SharedFrameBuffer] = None
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self.commands: Optional[multiprocessing.queues.Queue] = None
+        self._last_frame = MapFrame(
+            0,
+            time.time(),
+            np.empty(0, dtype=np.int64),
+            np.empty((0, 2), dtype=np.float32),
+            np.empty(0, dtype=np.bool_),
+            np.empty(0, dtype=np.float64),
+            {"x": 0.0, "y": 0.0, "confidence": 0.0},
+            {"small": 0, "large": 0},
+        )
+        self._encoded_state: Tuple[Optional[int], bytes] = (None, b"")
+        self.density = DensityGrid(field.width, field.height)
+
+    async def start(self) -> None:
+        if self.process is not None:
+            return
+        context = multiprocessing.get_context("spawn")
+        self.frames = SharedFrameBuffer(self.capacity)
+        self.commands = context.Queue()
+        self.process = context.Process(
+            target=_crowd_worker,
+            args=(
+                self.field.image_path,
+                self.field.cache_dir,
+                self.frames.name,
+                self.capacity,
+                self.max_agents,
+                self.crowd_size,
+                self.commands,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+
+    async def stop(self) -> None:
+        if self.process is None:
+            return
+        self.commands.put(("stop",))
+        await asyncio.get_running_loop().run_in_executor(None, self.process.join, 5.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process = None
+        self.commands.close()
+        self.frames.close(unlink=True)
+        self.frames = None
+
+    def _send(self, *command: object) -> bool:
+        if self.commands is None:
+            return False
+        self.commands.put_nowait(command)
+        return True
+
+    async def apply_move(self, person_id: int, x: float, y: float) -> bool:
+        return self._send("move", person_id, x, y)
+
+    async def toggle_state(self, person_id: int, desired_state: Optional[str] = None) -> bool:
+        return self._send("toggle", person_id, desired_state)
+
+    async def apply_batch(
+        self, moves: Sequence[Tuple[int, float, float]], toggles: Sequence[Tuple[int, Optional[str]]]
+    ) -> int:
+        return len(moves) + len(toggles) if self._send("batch", list(moves), list(toggles)) else 0
+
+    async def apply_goals(self, goals: Optional[Sequence[Tuple[float, float]]]) -> bool:
+        return self._send("goals", list(goals) if goals else None)
+
+    async def reset(self) -> None:
+        self._send("reset")
+
+    def _refresh(self) -> None:
+        if self.frames is None:
+            return
+        frame = self.frames.read()
+        if frame is None or frame.tick == self._last_frame.tick:
+            return
+        elapsed = frame.timestamp - self._last_frame.timestamp if self._last_frame.tick > 0 else 0.0
+        self.density.update(frame.positions, frame.is_large, max(0.0, elapsed))
+        frame.fhu["hotspots"] = self.density.last_hotspots
+        self._last_frame = frame
+
+    def encoded_state(self) -> bytes:
+        self._refresh()
+        frame = self._last_frame
+        tick, encoded = self._encoded_state
+        if tick != frame.tick:
+            encoded = frame.encode_state(self.field.width, self.field.height)
+            self._encoded_state = (frame.tick, encoded)
+        return encoded
+
+    async def latest(self) -> MapFrame:
+        self._refresh()
+        return self._last_frame
+
+    def render_metrics(self) -> List[str]:
+        lines = self.frames.read_metrics() if self.frames is not None else []
+        alive = 1 if self.process is not None and self.process.is_alive() else 0
+        lines += render_metric("crowd_worker_alive", "gauge", "Whether the simulation worker is running.", alive)
+        return lines
+
+
+def _crowd_worker(
+    image_path: Path,
+    cache_dir: Optional[Path],
+    shm_name: str,
+    capacity: int,
+    max_agents: int,
+    crowd_size: Optional[int],
+    commands: multiprocessing.queues.Queue,
+) -> None:
+    field = CollisionField(image_path, cache_dir=cache_dir)
+    crowd = Crowd(field, max_agents=max_agents, crowd_size=crowd_size)
+    crowd.set_goals(CROWD_GOALS)
+    frames = SharedFrameBuffer(capacity, name=shm_name)
+    scheduler = FixedStepScheduler()
+    metrics_every = max(1, int(scheduler.rate_hz))
+
+    async def step(current_time: float, dt: float) -> None:
+        while True:
+            try:
+                command = commands.get_nowait()
+            except queue.Empty:
+                break
+            if command[0] == "stop":
+                raise asyncio.CancelledError
+            crowd.handle_command(command)
+        crowd.tick(current_time, dt)
+        frames.write(crowd._last_frame)
+        if crowd.tick_count % metrics_every == 1:
+            frames.write_metrics(scheduler.render_metrics() + crowd.render_metrics())
+
+    try:
+        asyncio.run(scheduler.run(step))
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        pass
+    finally:
+        frames.close()
+
+
+class BinaryFrameEncoder:
+
+    # Little-endian frame: 48-byte header, then last_unshrinked_at f64[n], ids u32[n],
+    # positions f32[n, 2] and state u8[n] (bit 0 = large). Keyframes replace the client's
+    # agent set; deltas only carry agents that are new or changed since the last frame sent.
+    MAGIC = b"CRWD"
+    VERSION = 1
+    KEYFRAME = 0
+    DELTA = 1
+    HEADER = struct.Struct("<4sBBHIdfffIII4x")
+    STATE_LARGE = 0x01
+
+    def __init__(self, keyframe_interval: int = 30, position_epsilon: float = 0.25):
+        self.keyframe_interval = keyframe_interval
+        self.position_epsilon = position_epsilon
+        self.last_kind = self.KEYFRAME
+        self._frames_since_keyframe = 0
+        self._ids: Optional[np.ndarray] = None
+        self._positions = np.empty((0, 2), dtype=np.float32)
+        self._is_large = np.empty(0, dtype=np.bool_)
+        self._last_unshrinked_at = np.empty(0, dtype=np.float64)
+
+    def _needs_keyframe(self, frame: MapFrame) -> bool:
+        if self._ids is None or self._frames_since_keyframe >= self.keyframe_interval:
+            return True
+        known = len(self._ids)
+        return len(frame.ids) < known or not np.array_equal(frame.ids[:known], self._ids)
+
+    def encode(self, frame: MapFrame) -> bytes:
+        if self._needs_keyframe(frame):
+            self._frames_since_keyframe = 0
+            self._ids = frame.ids.copy()
+            self._positions = frame.positions.copy()
+            self._is_large = frame.is_large.copy()
+            self._last_unshrinked_at = frame.last_unshrinked_at.copy()
+            self.last_kind = self.KEYFRAME
+            return self.keyframe(frame)
+
+        known = len(self._ids)
+        moved = np.abs(frame.positions[:known] - self._positions).max(axis=1) > self.position_epsilon
+        flipped = (frame.is_large[:known] != self._is_large) | (
+            frame.last_unshrinked_at[:known] != self._last_unshrinked_at
+        )
+        changed = np.concatenate((np.flatnonzero(moved | flipped), np.arange(known, len(frame.ids))))
+        self._frames_since_keyframe += 1
+        self._ids = frame.ids.copy()
+        self._positions = np.concatenate((self._positions, frame.positions[known:]))
+        self._is_large = np.concatenate((self._is_large, frame.is_large[known:]))
+        self._last_unshrinked_at = np.concatenate((self._last_unshrinked_at, frame.last_unshrinked_at[known:]))
+        self._positions[changed] = frame.positions[changed]
+        self._is_large[changed] = frame.is_large[changed]
+        self._last_unshrinked_at[changed] = frame.last_unshrinked_at[changed]
+        self.last_kind = self.DELTA
+        return self._pack(self.DELTA, frame, changed)
+
+    def keyframe(self, frame: MapFrame) -> bytes:
+        return self._pack(self.KEYFRAME, frame, np.arange(len(self._ids)))
+
+    def _pack(self, kind: int, frame: MapFrame, rows: np.ndarray) -> bytes:
+        header = self.HEADER.pack(
+            self.MAGIC,
+            self.VERSION,
+            kind,
+            0,
+            frame.tick & 0xFFFFFFFF,
+            frame.timestamp,
+            frame.fhu["x"],
+            frame.fhu["y"],
+            frame.fhu["confidence"],
+            frame.counts["large"],
+            frame.counts["small"],
+            len(rows),
+        )
+        states = self._is_large[rows].astype(np.uint8) * self.STATE_LARGE
+        return b"".join(
+            (
+                header,
+                self._last_unshrinked_at[rows].astype("<f8").tobytes(),
+                self._ids[rows].astype("<u4").tobytes(),
+                self._positions[rows].astype("<f4").tobytes(),
+                states.tobytes(),
+            )
+        )
+
+
+class MapSubscriber:
+    FORMATS = {"json", "binary"}
+    DEFAULT_HEATMAP_CELL = 32
+    MAX_HEATMAP_CELL = 512
+    DEFAULT_VIEWPORT_AGENTS = 2000
+    AUTO_CLUSTERS_ACROSS = 48
+
+    def __init__(self, subscriber_id: int, max_queue: int):
+        self.subscriber_id = subscriber_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.binary = False
+        self.needs_keyframe = False
+        self.hello: Optional[Dict[str, object]] = None
+        self.sent_frames = 0
+        self.dropped_frames = 0
+        self.last_sent_tick = 0
+        self.last_latency = 0.0
+        self.positions = True
+        self.heatmap_cell: Optional[int] = None
+        self.viewport: Optional[Tuple[float, float, float, float]] = None
+        self.lod = 0.0
+        self.max_agents = MapSubscriber.DEFAULT_VIEWPORT_AGENTS
+        self.encoder: Optional[BinaryFrameEncoder] = None
+
+    def flush(self) -> int:
+        flushed = 0
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            flushed += 1
+        return flushed
+
+    def resync(self) -> None:
+        self.dropped_frames += self.flush()
+        self.needs_keyframe = True
+
+    def offer(self, tick: int, payload: object, published_at: float) -> None:
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped_frames += 1
+        self.queue.put_nowait((tick, payload, published_at))
+
+    def record_sent(self, tick: int, published_at: float) -> None:
+        self.sent_frames += 1
+        self.last_sent_tick = tick
+        self.last_latency = time.monotonic() - published_at
+
+
+class MapBroadcastHub:
+    def __init__(
+        self,
+        crowd: Union[Crowd, CrowdProcess],
+        field: CollisionField,
+        max_queue: int = 8,
+        socket_metrics: Optional[SocketMetrics] = None,
+        heatmap_interval: float = 0.25,
+    ):
+        self.crowd = crowd
+        self.field = field
+        self.heatmap_interval = heatmap_interval
+        self.next_heatmap_at = 0.0
+        self.socket_metrics = socket_metrics or SocketMetrics("map")
+        self.max_queue = max_queue
+        self.encoder = BinaryFrameEncoder()
+        self.subscribers: Dict[int, MapSubscriber] = {}
+        self.published_frames = 0
+        self.last_tick = -1
+        self.next_subscriber_id = 0
+        self.viewport_index = SpatialHashGrid(64.0)
+
+    def subscribe(self, stream_format: Optional[str] = None) -> MapSubscriber:
+        subscriber = MapSubscriber(self.next_subscriber_id, self.max_queue)
+        subscriber.last_sent_tick = max(self.last_tick, 0)
+        self.next_subscriber_id += 1
+        self.subscribers[subscriber.subscriber_id] = subscriber
+        self.set_format(subscriber, stream_format or "json")
+        return subscriber
+
+    def unsubscribe(self, subscriber: MapSubscriber) -> None:
+        self.subscribers.pop(subscriber.subscriber_id, None)
+
+    def close(self) -> None:
+        for subscriber in self.subscribers.values():
+            subscriber.flush()
+            subscriber.queue.put_nowait((self.last_tick, None, time.monotonic()))
+        self.subscribers.clear()
+
+    def set_viewport(
+        self,
+        subscriber: MapSubscriber,
+        viewport: Optional[Tuple[float, float, float, float]],
+        lod: float = 0.0,
+        max_agents: int = MapSubscriber.DEFAULT_VIEWPORT_AGENTS,
+    ) -> None:
+        subscriber.viewport = viewport
+        subscriber.lod = lod if math.isfinite(lod) and lod > 0 else 0.0
+        subscriber.max_agents = max(1, max_agents)
+        subscriber.encoder = BinaryFrameEncoder() if viewport is not None and subscriber.binary else None
+        subscriber.needs_keyframe = subscriber.binary
+
+    def set_heatmap(self, subscriber: MapSubscriber, cell_size: Optional[int], positions: bool = True) -> None:
+        if cell_size is not None:
+            cell_size = int(np.clip(cell_size, self.crowd.density.cell_size, MapSubscriber.MAX_HEATMAP_CELL))
+        subscriber.heatmap_cell = cell_size
+        if positions and not subscriber.positions:
+            subscriber.needs_keyframe = subscriber.binary
+        subscriber.positions = positions or cell_size is None
+
+    def set_format(self, subscriber: MapSubscriber, stream_format: str) -> None:
+        if stream_format not in MapSubscriber.FORMATS:
+            return
+        subscriber.flush()
+        subscriber.binary = stream_format == "binary"
+        subscriber.needs_keyframe = subscriber.binary
+        subscriber.encoder = BinaryFrameEncoder() if subscriber.viewport is not None and subscriber.binary else None
+        subscriber.hello = None
+        if subscriber.binary:
+            subscriber.hello = {
+                "type": "hello",
+                "format": "binary",
+                "version": BinaryFrameEncoder.VERSION,
+                "map": {"width": self.field.width, "height": self.field.height},
+            }
+
+    async def publish(self) -> None:
+        if not self.subscribers:
+            return
+        frame = await self.crowd.latest()
+        if frame.tick == self.last_tick:
+            return
+        self.last_tick = frame.tick
+        self.published_frames += 1
+        published_at = time.monotonic()
+
+        subscribers = list(self.subscribers.values())
+        streaming = [
+            subscriber for subscriber in subscribers if subscriber.positions and subscriber.viewport is None
+        ]
+        if any(subscriber.positions and subscriber.viewport is not None for subscriber in subscribers):
+            self.viewport_index.rebuild(frame.positions)
+        text: Optional[str] = None
+        delta: Optional[bytes] = None
+        keyframe: Optional[bytes] = None
+        heatmaps: Dict[int, bytes] = {}
+        hotspots_text: Optional[str] = None
+        density = self.crowd.density
+        if published_at >= self.next_heatmap_at:
+            self.next_heatmap_at = published_at + self.heatmap_interval
+            started = time.perf_counter()
+            hotspots = {"type": "hotspots", "tick": frame.tick, "hotspots": density.hotspots()}
+            hotspots_text = dumps_json(hotspots).decode()
+            for cell_size in {subscriber.heatmap_cell for subscriber in subscribers} - {None}:
+                heatmaps[cell_size] = density.encode(frame.tick, frame.timestamp, cell_size)
+            self.socket_metrics.encode_seconds.observe(time.perf_counter() - started)
+        frame.fhu["hotspots"] = density.last_hotspots
+        if any(not subscriber.binary for subscriber in streaming):
+            started = time.perf_counter()
+            text = self.crowd.encoded_state().decode()
+            self.socket_metrics.encode_seconds.observe(time.perf_counter() - started)
+        if any(subscriber.binary for subscriber in streaming):
+            started = time.perf_counter()
+            delta = self.encoder.encode(frame)
+            self.socket_metrics.encode_seconds.observe(time.perf_counter() - started)
+            if self.encoder.last_kind == BinaryFrameEncoder.KEYFRAME:
+                keyframe = delta
+
+        for subscriber in subscribers:
+            extras: List[object] = []
+            if subscriber.heatmap_cell in heatmaps:
+                extras.append(heatmaps[subscriber.heatmap_cell])
+            if hotspots_text is not None and (subscriber.binary or not subscriber.positions):
+                extras.append(hotspots_text)
+            if not subscriber.positions:
+                for payload in extras:
+                    subscriber.offer(frame.tick, payload, published_at)
+                continue
+            if subscriber.viewport is not None:
+                self._publish_viewport(subscriber, frame, extras, published_at)
+                continue
+            if not subscriber.binary:
+                for payload in [text, *extras]:
+                    subscriber.offer(frame.tick, payload, published_at)
+                continue
+            if subscriber.queue.maxsize - subscriber.queue.qsize() < 1 + len(extras):
+                subscriber.resync()
+            for payload in extras:
+                subscriber.offer(frame.tick, payload, published_at)
+            payload = delta
+            if subscriber.needs_keyframe:
+                if keyframe is None:
+                    started = time.perf_counter()
+                    keyframe = self.encoder.keyframe(frame)
+                    self.socket_metrics.encode_seconds.observe(time.perf_counter() - started)
+                subscriber.needs_keyframe = False
+                payload = keyframe
+            subscriber.offer(frame.tick, payload, published_at)
+
+    def _publish_viewport(
+        self,
+        subscriber: MapSubscriber,
+        frame: MapFrame,
+        extras: List[object],
+        published_at: float,
+    ) -> None:
+        started = time.perf_counter()
+        x0, y0, x1, y1 = subscriber.viewport
+        visible = self.viewport_index.query_rect(x0, y0, x1, y1)
+        cluster_cell = subscriber.lod
+        if cluster_cell <= 0 and len(visible) > subscriber.max_agents:
+            cluster_cell = max(x1 - x0, y1 - y0) / MapSubscriber.AUTO_CLUSTERS_ACROSS
+        clusters = frame.clusters(visible, cluster_cell) if cluster_cell > 0 else None
+        subset = frame.subset(visible if clusters is None else visible[:0])
+        summary = {
+            "viewport": {"x": x0, "y": y0, "width": x1 - x0, "height": y1 - y0},
+            "visible": len(visible),
+            "cluster_cell": cluster_cell if clusters is not None else 0.0,
+            "clusters": clusters or [],
+        }
+
+        payloads = list(extras)
+        if subscriber.binary:
+            if subscriber.needs_keyframe or subscriber.encoder is None:
+                subscriber.encoder = BinaryFrameEncoder()
+                subscriber.needs_keyframe = False
+            payloads.append(subscriber.encoder.encode(subset))
+            if clusters is not None:
+                message = {"type": "clusters", "tick": frame.tick, **summary}
+                payloads.append(dumps_json(message).decode())
+        else:
+            message = {"type": "state", **subset.to_state(self.field.width, self.field.height), **summary}
+            payloads.append(dumps_json(message).decode())
+        self.socket_metrics.encode_seconds.observe(time.perf_counter() - started)
+
+        if subscriber.binary and subscriber.queue.maxsize - subscriber.queue.qsize() < len(payloads):
+            subscriber.resync()
+            subscriber.encoder = BinaryFrameEncoder()
+            subscriber.needs_keyframe = False
+            payloads[-1 if clusters is None else -2] = subscriber.encoder.encode(subset)
+        for payload in payloads:
+            subscriber.offer(frame.tick, payload, published_at)
+
+    def metrics(self) -> Dict[str, object]:
+        clients = [
+            {
+                "id": subscriber.subscriber_id,
+                "format": "binary" if subscriber.binary else "json",
+                "positions": subscriber.positions,
+                "heatmap_cell": subscriber.heatmap_cell,
+                "viewport": subscriber.viewport,
+                "lod": subscriber.lod,
+                "queued": subscriber.queue.qsize(),
+                "sent_frames": subscriber.sent_frames,
+                "dropped_frames": subscriber.dropped_frames,
+                "lag_ticks": max(0, self.last_tick - subscriber.last_sent_tick),
+                "latency_ms": subscriber.last_latency * 1000.0,
+            }
+            for subscriber in self.subscribers.values()
+        ]
+        return {
+            "subscribers": len(clients),
+            "published_frames": self.published_frames,
+            "dropped_frames": sum(client["dropped_frames"] for client in clients),
+            "clients": clients,
+        }
+
+
+class TrajectorySegment:
+    MAGIC = b"CTRJ"
+    VERSION = 1
+    HEADER = struct.Struct("<4sIQQQQ")
+    HEADER_BYTES = 64
+    TICK_COLUMNS = (
+        ("tick", np.uint64, ()),
+        ("timestamp", np.float64, ()),
+        ("row_offset", np.uint64, ()),
+        ("row_count", np.uint32, ()),
+        ("fhu", np.float32, (3,)),
+        ("counts", np.uint32, (2,)),
+    )
+    ROW_COLUMNS = (
+        ("ids", np.int64, ()),
+        ("positions", np.float32, (2,)),
+        ("last_unshrinked_at", np.float64, ()),
+        ("is_large", np.bool_, ()),
+    )
+
+    def __init__(self, path: Path, tick_capacity: int = 0, row_capacity: int = 0, readonly: bool = False):
+        self.path = path
+        create = tick_capacity > 0
+        mode = "r" if readonly and not create else "r+"
+        if create:
+            with open(path, "wb") as handle:
+                handle.truncate(self.segment_bytes(tick_capacity, row_capacity))
+            self.ticks = self.rows = 0
+        self._header = np.memmap(path, dtype=np.uint8, mode=mode, shape=(self.HEADER_BYTES,))
+        if create:
+            self.tick_capacity, self.row_capacity = tick_capacity, row_capacity
+            self._write_header()
+        else:
+            magic, version, self.tick_capacity, self.row_capacity, self.ticks, self.rows = self.HEADER.unpack_from(
+                self._header
+            )
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError(f"{path} is not a trajectory segment")
+        self.columns: Dict[str, np.ndarray] = {}
+        offset = self.HEADER_BYTES
+        for columns, capacity in ((self.TICK_COLUMNS, self.tick_capacity), (self.ROW_COLUMNS, self.row_capacity)):
+            for name, dtype, shape in columns:
+                self.columns[name] = np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=(capacity, *shape))
+                offset += self._aligned(capacity * np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64)))
+
+    @staticmethod
+    def _aligned(size: int) -> int:
+        return -(-size // 8) * 8
+
+    @classmethod
+    def segment_bytes(cls, tick_capacity: int, row_capacity: int) -> int:
+        size = cls.HEADER_BYTES
+        for columns, capacity in ((cls.TICK_COLUMNS, tick_capacity), (cls.ROW_COLUMNS, row_capacity)):
+            for _, dtype, shape in columns:
+                size += cls._aligned(capacity * np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64)))
+        return size
+
+    @classmethod
+    def row_capacity_for(cls, segment_bytes: int, tick_capacity: int) -> int:
+        row_bytes = sum(
+            np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64)) for _, dtype, shape in cls.ROW_COLUMNS
+        )
+        return max(0, (segment_bytes - cls.segment_bytes(tick_capacity, 0)) // row_bytes - len(cls.ROW_COLUMNS))
+
+    def _write_header(self) -> None:
+        self.HEADER.pack_into(
+            self._header, 0, self.MAGIC, self.VERSION, self.tick_capacity, self.row_capacity, self.ticks, self.rows
+        )
+
+    def append(self, frame: MapFrame) -> bool:
+        count = len(frame.ids)
+        if self.ticks >= self.tick_capacity or self.rows + count > self.row_capacity:
+            return False
+        columns, tick, rows = self.columns, self.ticks, slice(self.rows, self.rows + count)
+        columns["ids"][rows] = frame.ids
+        columns["positions"][rows] = frame.positions
+        columns["last_unshrinked_at"][rows] = frame.last_unshrinked_at
+        columns["is_large"][rows] = frame.is_large
+        columns["tick"][tick] = frame.tick
+        columns["timestamp"][tick] = frame.timestamp
+        columns["row_offset"][tick] = self.rows
+        columns["row_count"][tick] = count
+        columns["fhu"][tick] = (frame.fhu["x"], frame.fhu["y"], frame.fhu["confidence"])
+        columns["counts"][tick] = (frame.counts["large"], frame.counts["small"])
+        self.ticks += 1
+        self.rows += count
+        self._write_header()
+        return True
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self.columns["timestamp"][: self.ticks]
+
+    def frame(self, index: int) -> MapFrame:
+        columns = self.columns
+        offset = int(columns["row_offset"][index])
+        rows = slice(offset, offset + int(columns["row_count"][index]))
+        x, y, confidence = columns["fhu"][index].tolist()
+        large, small = columns["counts"][index].tolist()
+        return MapFrame(
+            int(columns["tick"][index]),
+            float(columns["timestamp"][index]),
+            np.array(columns["ids"][rows]),
+            np.array(columns["positions"][rows]),
+            np.array(columns["is_large"][rows]),
+            np.array(columns["last_unshrinked_at"][rows]),
+            {"x": x, "y": y, "confidence": confidence},
+            {"large": large, "small": small},
+        )
+
+    def flush(self) -> None:
+        for array in (self._header, *self.columns.values()):
+            array.flush()
+
+
+class TrajectoryLog:
+    SUFFIX = ".traj"
+
+    def __init__(
+        self,
+        directory: Path,
+        segment_bytes: int = 16 << 20,
+        max_segments: int = 4,
+        tick_capacity: int = 1 << 16,
+        readonly: bool = False,
+    ):
+        self.directory = directory
+        self.max_segments = max_segments
+        self.tick_capacity = tick_capacity
+        self.row_capacity = TrajectorySegment.row_capacity_for(segment_bytes, tick_capacity)
+        self.readonly = readonly
+        self.segments: List[TrajectorySegment] = []
+        self.next_index = 0
+        self.last_timestamp = -math.inf
+        self.dropped_frames = 0
+        if not readonly:
+            directory.mkdir(parents=True, exist_ok=True)
+        for path in sorted(directory.glob(f"*{self.SUFFIX}")):
+            try:
+                segment = TrajectorySegment(path, readonly=readonly)
+            except (OSError, ValueError) as exc:
+                print(f"Skipping unreadable trajectory segment {path}: {exc}")
+                continue
+            self.segments.append(segment)
+            self.next_index = max(self.next_index, int(path.stem) + 1)
+            if segment.ticks:
+                self.last_timestamp = max(self.last_timestamp, float(segment.timestamps[-1]))
+        self._active: Optional[TrajectorySegment] = None
+
+    def append(self, frame: MapFrame) -> None:
+        if self.readonly or frame.tick == 0 or frame.timestamp <= self.last_timestamp:
+            return
+        if self._active is None or not self._active.append(frame):
+            self._rotate()
+            if not self._active.append(frame):
+                self.dropped_frames += 1
+                return
+        self.last_timestamp = frame.timestamp
+
+    def _rotate(self) -> None:
+        if self._active is not None:
+            self._active.flush()
+        path = self.directory / f"{self.next_index:08d}{self.SUFFIX}"
+        self.next_index += 1
+        self._active = TrajectorySegment(path, self.tick_capacity, self.row_capacity)
+        self.segments.append(self._active)
+        while len(self.segments) > self.max_segments:
+            expired = self.segments.pop(0)
+            with contextlib.suppress(OSError):
+                expired.path.unlink()
+
+    def close(self) -> None:
+        if self._active is not None:
+            self._active.flush()
+            self._active = None
+
+    def bounds(self) -> Dict[str, object]:
+        populated = [segment for segment in self.segments if segment.ticks]
+        return {
+            "start": float(populated[0].timestamps[0]) if populated else None,
+            "end": float(populated[-1].timestamps[-1]) if populated else None,
+            "ticks": sum(segment.ticks for segment in populated),
+            "segments": len(self.segments),
+            "bytes": sum(segment.path.stat().st_size for segment in self.segments if segment.path.exists()),
+            "dropped_frames": self.dropped_frames,
+        }
+
+    def iter_frames(self, start: float, end: float, resolution: float = 0.0) -> Iterator[MapFrame]:
+        last_bucket = -1
+        for segment in list(self.segments):
+            timestamps = segment.timestamps
+            if not len(timestamps) or timestamps[-1] < start or timestamps[0] > end:
+                continue
+            first = int(np.searchsorted(timestamps, start, side="left"))
+            stop = int(np.searchsorted(timestamps, end, side="right"))
+            indices = np.arange(first, stop)
+            if resolution > 0:
+                buckets = ((timestamps[first:stop] - start) // resolution).astype(np.int64)
+                keep = np.flatnonzero(np.diff(buckets, prepend=last_bucket) > 0)
+                indices = indices[keep]
+                if len(buckets):
+                    last_bucket = int(buckets[-1])
+            for index in indices.tolist():
+                yield segment.frame(index)
+
+    def query(
+        self, start: float, end: float, resolution: float, max_frames: int = 600
+    ) -> Tuple[float, List[MapFrame]]:
+        resolution = max(resolution, (end - start) / max(1, max_frames), 0.0)
+        frames = list(itertools.islice(self.iter_frames(start, end, resolution), max_frames))
+        return resolution, frames
+
+
+class CrowdRoom:
+    def __init__(
+        self,
+        name: str,
+        crowd: Union[Crowd, CrowdProcess],
+        hub: MapBroadcastHub,
+        log: Optional[TrajectoryLog] = None,
+    ):
+        self.name = name
+        self.crowd = crowd
+        self.hub = hub
+        self.log = log
+        self.created_at = time.monotonic()
+        self.last_active = self.created_at
+        self.failures = {"tick": 0, "publish": 0}
+
+    def touch(self) -> None:
+        self.last_active = time.monotonic()
+
+    def summary(self) -> Dict[str, object]:
+        return {
+            "name": self.name,
+            "subscribers": len(self.hub.subscribers),
+            "published_frames": self.hub.published_frames,
+            "idle_seconds": time.monotonic() - self.last_active,
+            "worker": isinstance(self.crowd, CrowdProcess),
+        }
+
+
+class RoomManager:
+    NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+    FAILURE_LIMIT = 5
+
+    def __init__(
+        self,
+        field: CollisionField,
+        factory: Callable[[CollisionField], Union[Crowd, CrowdProcess]],
+        idle_timeout: float = 300.0,
+        max_rooms: int = 64,
+        publish_hz: float = 15.0,
+        heatmap_interval: float = 0.25,
+        pinned: Sequence[str] = (DEFAULT_ROOM,),
+        log_dir: Optional[Path] = None,
+        log_segment_bytes: int = 16 << 20,
+        log_segments: int = 4,
+        log_rooms: Optional[Sequence[str]] = (DEFAULT_ROOM,),
+    ):
+        self.field = field
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self.max_rooms = max_rooms
+        self.publish_interval = 1.0 / publish_hz
+        self.heatmap_interval = heatmap_interval
+        self.pinned = set(pinned)
+        self.log_dir = log_dir
+        self.log_segment_bytes = log_segment_bytes
+        self.log_segments = log_segments
+        self.log_rooms = set(log_rooms) if log_rooms is not None else None
+        self.rooms: Dict[str, CrowdRoom] = {}
+        self.scheduler = FixedStepScheduler()
+        self.phases = PhaseTimer(Crowd.PHASES)
+        self.socket_metrics = SocketMetrics("map")
+        self.created_rooms = 0
+        self.evicted_rooms = 0
+        self.rejected_rooms = 0
+        self.failed_rooms = 0
+        self.started = False
+        self.tick_task: Optional[asyncio.Task] = None
+        self.publish_task: Optional[asyncio.Task] = None
+
+    def valid_name(self, name: str) -> bool:
+        return bool(self.NAME_PATTERN.match(name))
+
+    def get(self, name: str) -> Optional[CrowdRoom]:
+        return self.rooms.get(name)
+
+    def records(self, name: str) -> bool:
+        return self.log_dir is not None and (self.log_rooms is None or name in self.log_rooms)
+
+    def _prune_logs(self) -> None:
+        if self.log_dir is None:
+            return
+        try:
+            stale = [path for path in self.log_dir.iterdir() if path.is_dir() and not self.records(path.name)]
+        except OSError:
+            return
+        for path in stale:
+            shutil.rmtree(path, ignore_errors=True)
+
+    async def open(self, name: str) -> Optional[CrowdRoom]:
+        room = self.rooms.get(name)
+        if room is None:
+            if not self.valid_name(name) or len(self.rooms) >= self.max_rooms:
+                self.rejected_rooms += 1
+                return None
+            crowd = self.factory(self.field)
+            if isinstance(crowd, Crowd):
+                crowd.phases = self.phases
+            log = None
+            if self.records(name):
+                try:
+                    log = TrajectoryLog(
+                        self.log_dir / name, segment_bytes=self.log_segment_bytes, max_segments=self.log_segments
+                    )
+                except OSError as exc:
+                    print(f"Could not open trajectory log for room {name}, recording disabled: {exc}")
+            hub = MapBroadcastHub(
+                crowd, self.field, socket_metrics=self.socket_metrics, heatmap_interval=self.heatmap_interval
+            )
+            room = CrowdRoom(name, crowd, hub, log)
+            self.rooms[name] = room
+            self.created_rooms += 1
+            if self.started and isinstance(crowd, CrowdProcess):
+                await crowd.start()
+        room.touch()
+        return room
+
+    async def start(self) -> None:
+        if self.started:
+            return
+        self.started = True
+        self._prune_logs()
+        for name in self.pinned:
+            await self.open(name)
+        for room in list(self.rooms.values()):
+            if isinstance(room.crowd, CrowdProcess):
+                await room.crowd.start()
+        self.tick_task = asyncio.create_task(self.scheduler.run(self._tick_rooms))
+        self.publish_task = asyncio.create_task(self._publish_rooms())
+
+    async def stop(self) -> None:
+        for task in (self.publish_task, self.tick_task):
+            if task is not None:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+        self.publish_task = self.tick_task = None
+        for room in list(self.rooms.values()):
+            if isinstance(room.crowd, CrowdProcess):
+                await room.crowd.stop()
+            if room.log is not None:
+                room.log.close()
+        self.started = False
+
+    def history(self, name: str) -> Optional[TrajectoryLog]:
+        room = self.rooms.get(name)
+        if room is not None:
+            return room.log
+        if self.log_dir is None or not self.valid_name(name) or not (self.log_dir / name).is_dir():
+            return None
+        return TrajectoryLog(self.log_dir / name, readonly=True)
+
+    async def _tick_rooms(self, current_time: float, dt: float) -> None:
+        for room in list(self.rooms.values()):
+            try:
+                await self._tick_room(room, current_time, dt)
+            except Exception as exc:
+                await self._room_failed(room, "tick", exc)
+            else:
+                room.failures["tick"] = 0
+
+    async def _tick_room(self, room: CrowdRoom, current_time: float, dt: float) -> None:
+        crowd = room.crowd
+        if isinstance(crowd, Crowd):
+            async with crowd.lock:
+                crowd.tick(current_time, dt)
+                self._record(room, crowd._last_frame)
+        elif room.log is not None:
+            self._record(room, await crowd.latest())
+
+    def _record(self, room: CrowdRoom, frame: MapFrame) -> None:
+        if room.log is None:
+            return
+        try:
+            room.log.append(frame)
+        except OSError as exc:
+            print(f"Could not write trajectory log for room {room.name}, recording disabled: {exc}")
+            with contextlib.suppress(OSError):
+                room.log.close()
+            room.log = None
+
+    async def _publish_rooms(self) -> None:
+        while True:
+            for room in list(self.rooms.values()):
+                if not room.hub.subscribers:
+                    continue
+                room.touch()
+                try:
+                    await room.hub.publish()
+                except Exception as exc:
+                    await self._room_failed(room, "publish", exc)
+                else:
+                    room.failures["publish"] = 0
+            try:
+                await self.evict_idle()
+            except Exception as exc:
+                print(f"Error evicting idle rooms: {exc}")
+            await asyncio.sleep(self.publish_interval)
+
+    async def _room_failed(self, room: CrowdRoom, stage: str, exc: Exception) -> None:
+        room.failures[stage] += 1
+        print(f"Error in room {room.name} {stage} ({room.failures[stage]}/{self.FAILURE_LIMIT}): {exc!r}")
+        if room.failures[stage] < self.FAILURE_LIMIT or self.rooms.get(room.name) is not room:
+            return
+        print(f"Closing room {room.name} after {self.FAILURE_LIMIT} consecutive {stage} failures")
+        del self.rooms[room.name]
+        self.failed_rooms += 1
+        await self._close_room(room)
+        if room.name in self.pinned:
+            await self.open(room.name)
+
+    async def _close_room(self, room: CrowdRoom) -> None:
+        room.hub.close()
+        if isinstance(room.crowd, CrowdProcess):
+            await room.crowd.stop()
+        if room.log is not None:
+            with contextlib.suppress(OSError):
+                room.log.close()
+
+    async def evict_idle(self) -> int:
+        cutoff = time.monotonic() - self.idle_timeout
+        idle = [
+            room
+            for room in self.rooms.values()
+            if room.name not in self.pinned and not room.hub.subscribers and room.last_active < cutoff
+        ]
+        for room in idle:
+            del self.rooms[room.name]
+            await self._close_room(room)
+        self.evicted_rooms += len(idle)
+        return len(idle)
+
+    def metrics(self) -> Dict[str, object]:
+        return {
+            "rooms": [room.summary() for room in self.rooms.values()],
+            "created": self.created_rooms,
+            "evicted": self.evicted_rooms,
+            "rejected": self.rejected_rooms,
+            "failed": self.failed_rooms,
+        }
+
+    def render_metrics(self) -> List[str]:
+        crowds = [room.crowd for room in self.rooms.values()]
+        local = [crowd for crowd in crowds if isinstance(crowd, Crowd)]
+        lines: List[str] = []
+        if local or not crowds:
+            lines += self.scheduler.render_metrics()
+            lines += self.phases.render("crowd_tick_phase_seconds", "Wall time spent per simulation tick phase.")
+            agents = sum(len(crowd.agents) for crowd in local)
+            received = sum(crowd.commands_received for crowd in local)
+            applied = sum(crowd.commands_applied for crowd in local)
+            lines += render_metric("crowd_agents", "gauge", "Agents currently simulated.", agents)
+            lines += render_metric(
+                "crowd_commands_received_total", "counter", "Move/toggle commands queued.", received
+            )
+            lines += render_metric(
+                "crowd_commands_applied_total", "counter", "Commands applied after coalescing.", applied
+            )
+        else:
+            sources = [(room.name, room.crowd.render_metrics()) for room in self.rooms.values()]
+            lines += _merge_labelled(sources, "room")
+        lines += render_metric("crowd_rooms", "gauge", "Rooms currently loaded.", len(crowds))
+        lines += render_metric("crowd_rooms_created_total", "counter", "Rooms created.", self.created_rooms)
+        lines += render_metric("crowd_rooms_evicted_total", "counter", "Idle rooms evicted.", self.evicted_rooms)
+        lines += render_metric(
+            "crowd_rooms_rejected_total", "counter", "Room requests refused (bad name or full).", self.rejected_rooms
+        )
+        lines += render_metric(
+            "crowd_rooms_failed_total", "counter", "Rooms closed after repeated errors.", self.failed_rooms
+        )
+        lines += self.socket_metrics.render_metrics()
+        return lines
+
+
+def _create_crowd(field: CollisionField) -> Union[Crowd, CrowdProcess]:
+    if WORKER_PROCESS:
+        return CrowdProcess(field, max_agents=MAX_AGENTS)
+    crowd = Crowd(field, max_agents=MAX_AGENTS)
+    crowd.set_goals(CROWD_GOALS)
+    return crowd
+
+
+collision_field: CollisionField
+rooms: RoomManager
+profiler = SamplingProfiler(PROFILER_INTERVAL)
+replay_metrics = SocketMetrics("replay")
 
 
 @app.on_event("startup")
 async def startup_event() -> None:
-    await simulation.start()
+    global collision_field, rooms, audio_executor, danger_monitor
+    collision_field = CollisionField(MAP_PATH, cache_dir=COLLISION_CACHE_DIR)
+    rooms = RoomManager(
+        collision_field,
+        _create_crowd,
+        idle_timeout=ROOM_IDLE_SECONDS,
+        max_rooms=MAX_ROOMS,
+        heatmap_interval=HEATMAP_INTERVAL,
+        log_dir=Path(TRAJECTORY_LOG_DIR) if TRAJECTORY_LOG_DIR else None,
+        log_segment_bytes=TRAJECTORY_SEGMENT_MB << 20,
+        log_segments=TRAJECTORY_SEGMENTS,
+        log_rooms=None if TRAJECTORY_ROOMS == "*" else [name for name in TRAJECTORY_ROOMS.split(",") if name],
+    )
+    audio_executor = ThreadPoolExecutor(max_workers=AUDIO_DSP_WORKERS, thread_name_prefix="audio-dsp")
+    danger_monitor = DangerMonitor(audio_executor, frame_size=DANGER_FRAME_SIZE)
+    if PROFILER_ENABLED:
+        profiler.start()
+    await rooms.start()
+    await danger_monitor.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_event() -> None:
-    await simulation.stop()
+    await rooms.stop()
+    await danger_monitor.stop()
+    audio_executor.shutdown(wait=False, cancel_futures=True)
+    profiler.stop()
 
 
-async def _map_state_stream(websocket: WebSocket) -> None:
-    try:
+async def _map_state_stream(websocket: WebSocket, subscriber: MapSubscriber, metrics: SocketMetrics) -> None:
+    while True:
+        tick, payload, published_at = await subscriber.queue.get()
+        if payload is None:
+            await websocket.close(code=1011)
+            return
+        if subscriber.hello is not None:
+            hello, subscriber.hello = subscriber.hello, None
+            await metrics.send_json(websocket, hello)
+        await metrics.send(websocket, payload)
+        subscriber.record_sent(tick, published_at)
+
+
+
+class StreamingResampler:
+    MAX_TABLES = 8
+
+    def __init__(self, ratio: float = 1.0, half_taps: int = 16, phases: int = 128):
+        self.half_taps = half_taps
+        self.phases = phases
+        self._taps = np.arange(-half_taps + 1, half_taps + 1)
+        self._tables: "OrderedDict[float, np.ndarray]" = OrderedDict()
+        self._tail = np.zeros(half_taps - 1, dtype=np.float32)
+        self._position = float(half_taps - 1)
+        self.ratio = 1.0
+        self.set_ratio(ratio)
+
+    def set_ratio(self, ratio: float) -> None:
+        if not math.isfinite(ratio) or ratio <= 0:
+            return
+        self.ratio = float(ratio)
+
+    def _table(self) -> np.ndarray:
+        table = self._tables.get(self.ratio)
+        if table is not None:
+            self._tables.move_to_end(self.ratio)
+        else:
+            cutoff = min(1.0, 1.0 / self.ratio)
+            offsets = self._taps[None, :] - np.arange(self.phases + 1)[:, None] / self.phases
+            window = np.clip(offsets / self.half_taps, -1.0, 1.0)
+            blackman = 0.42 + 0.5 * np.cos(np.pi * window) + 0.08 * np.cos(2 * np.pi * window)
+            table = cutoff * np.sinc(cutoff * offsets) * blackman
+            table /= table.sum(axis=1, keepdims=True)
+            table = table.astype(np.float32)
+            self._tables[self.ratio] = table
+            if len(self._tables) > self.MAX_TABLES:
+                self._tables.popitem(last=False)
+        return table
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        buffer = np.concatenate((self._tail, samples.astype(np.float32)))
+        last_center = len(buffer) - self.half_taps - 1
+        if self._position > last_center:
+            self._tail = buffer
+            return np.empty(0, dtype=np.int16)
+
+        count = int((last_center - self._position) // self.ratio) + 1
+        centers = self._position + np.arange(count) * self.ratio
+        base = np.floor(centers).astype(np.int64)
+        phase = np.rint((centers - base) * self.phases).astype(np.int64)
+        windows = buffer[base[:, None] + self._taps[None, :]]
+        output = np.einsum("ij,ij->i", windows, self._table()[phase])
+
+        self._position += count * self.ratio
+        consumed = int(math.floor(self._position)) - self.half_taps + 1
+        self._tail = buffer[consumed:].copy()
+        self._position -= consumed
+        return np.clip(np.rint(output), -32768, 32767).astype(np.int16)
+
+
+class AudioMetrics:
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self):
+        self.processing_seconds = Histogram(self.LATENCY_BUCKETS)
+        self.latency_seconds = Histogram(self.LATENCY_BUCKETS)
+        self.processed_chunks = 0
+        self.shed_chunks = 0
+        self.pipelines: Dict[int, "AudioPipeline"] = {}
+        self.socket = SocketMetrics("audio")
+
+    def render_metrics(self) -> List[str]:
+        queued = sum(pipeline.pending.qsize() for pipeline in self.pipelines.values())
+        lines = self.processing_seconds.render("audio_dsp_seconds", "Time spent resampling and encoding a chunk.")
+        lines += self.latency_seconds.render("audio_chunk_latency_seconds", "Time from chunk arrival to reply.")
+        lines += render_metric("audio_streams", "gauge", "Open /ws/audio connections.", len(self.pipelines))
+        lines += render_metric("audio_queue_depth", "gauge", "Chunks waiting for the DSP executor.", queued)
+        lines += render_metric("audio_chunks_total", "counter", "Chunks processed.", self.processed_chunks)
+        lines += render_metric("audio_chunks_shed_total", "counter", "Chunks shed by full queues.", self.shed_chunks)
+        lines += self.socket.render_metrics()
+        return lines
+
+
+class AudioPipeline:
+    def __init__(
+        self, websocket: WebSocket, executor: ThreadPoolExecutor, metrics: AudioMetrics, max_pending: int = 4
+    ):
+        self.websocket = websocket
+        self.executor = executor
+        self.metrics = metrics
+        self.resampler = StreamingResampler()
+        self.pending: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.metrics.pipelines[id(self)] = self
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self.metrics.pipelines.pop(id(self), None)
+        if self.task:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+
+    def submit(self, samples: object, ratio: float, sample_rate: int, binary: bool) -> None:
+        if self.pending.full():
+            self.pending.get_nowait()
+            self.metrics.shed_chunks += 1
+        self.pending.put_nowait((time.monotonic(), samples, ratio, sample_rate, binary))
+
+    def _render(
+        self, samples: object, ratio: float, sample_rate: int, binary: bool
+    ) -> Tuple[object, float, float]:
+        started = time.monotonic()
+        samples = np.asarray(samples, dtype=np.int16)
+        self.resampler.set_ratio(ratio)
+        modified_audio = self.resampler.process(samples)
+        encode_started = time.monotonic()
+        if binary:
+            payload: object = modified_audio.astype("<i2", copy=False).tobytes()
+        else:
+            payload = dumps_json(
+                {"type": "modified_audio_stream", "audio_data": modified_audio.tolist(), "sample_rate": sample_rate}
+            ).decode()
+        finished = time.monotonic()
+        return payload, finished - started, finished - encode_started
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
         while True:
-            payload = await simulation.snapshot()
-            await websocket.send_json({"type": "state", **payload})
-            await asyncio.sleep(1.0 / 15.0)
-    except WebSocketDisconnect:
-        raise
+            enqueued_at, samples, ratio, sample_rate, binary = await self.pending.get()
+            try:
+                payload, elapsed, encode_elapsed = await loop.run_in_executor(
+                    self.executor, self._render, samples, ratio, sample_rate, binary
+                )
+            except Exception as exc:
+                print(f"Error in real-time audio processing: {exc}")
+                continue
+            await self.metrics.socket.send(self.websocket, payload)
+            self.metrics.socket.encode_seconds.observe(encode_elapsed)
+            self.metrics.processed_chunks += 1
+            self.metrics.processing_seconds.observe(elapsed)
+            self.metrics.latency_seconds.observe(time.monotonic() - enqueued_at)
+
+
+class DangerStream:
+    def __init__(
+        self,
+        stream_id: int,
+        sample_rate: int,
+        frame_size: int,
+        notify: Callable[[Dict[str, object]], Awaitable[None]],
+        max_frames: int = 8,
+    ):
+        self.stream_id = stream_id
+        self.sample_rate = sample_rate
+        self.notify = notify
+        self.buffer = np.zeros(frame_size * max_frames, dtype=np.float32)
+        self.filled = 0
+        self.level = "none"
+        self.calm_frames = 0
+        self.last_alert_at = 0.0
+
+    def append(self, samples: np.ndarray) -> None:
+        samples = samples[-len(self.buffer) :]
+        overflow = self.filled + len(samples) - len(self.buffer)
+        if overflow > 0:
+            self.buffer[: self.filled - overflow] = self.buffer[overflow : self.filled]
+            self.filled -= overflow
+        target = self.buffer[self.filled : self.filled + len(samples)]
+        np.multiply(samples, 1.0 / 32768.0, out=target, casting="unsafe")
+        self.filled += len(samples)
+
+    def take_frames(self, frame_size: int, out: np.ndarray) -> int:
+        count = min(self.filled // frame_size, len(out))
+        if count == 0:
+            return 0
+        used = count * frame_size
+        out[:count] = self.buffer[:used].reshape(count, frame_size)
+        self.buffer[: self.filled - used] = self.buffer[used : self.filled]
+        self.filled -= used
+        return count
+
+
+class DangerMonitor:
+    BATCH_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+    def __init__(
+        self,
+        executor: ThreadPoolExecutor,
+        frame_size: int = 2048,
+        interval: float = 0.05,
+        low_band_hz: float = 250.0,
+        medium_amplitude: float = 0.7,
+        high_amplitude: float = 0.85,
+        low_band_share: float = 0.6,
+        low_band_floor: float = 0.1,
+        release_amplitude: float = 0.6,
+        release_low_band_share: float = 0.5,
+        release_frames: int = 3,
+        repeat_interval: float = 1.0,
+    ):
+        self.executor = executor
+        self.frame_size = frame_size
+        self.interval = interval
+        self.low_band_hz = low_band_hz
+        self.medium_amplitude = medium_amplitude
+        self.high_amplitude = high_amplitude
+        self.low_band_share = low_band_share
+        self.low_band_floor = low_band_floor
+        self.release_amplitude = release_amplitude
+        self.release_low_band_share = release_low_band_share
+        self.release_frames = release_frames
+        self.repeat_interval = repeat_interval
+        self.streams: Dict[int, DangerStream] = {}
+        self.next_stream_id = 0
+        self.analysed_frames = 0
+        self.alerts_sent = 0
+        self.batch_seconds = Histogram(self.BATCH_BUCKETS)
+        self.monitor_task: Optional[asyncio.Task] = None
+        self._window = np.hanning(frame_size).astype(np.float32)
+        self._frames = np.zeros((0, frame_size), dtype=np.float32)
+        self._windowed = np.zeros((0, frame_size), dtype=np.float32)
+        self._rates = np.zeros(0, dtype=np.float64)
+
+    def register(self, sample_rate: int, notify: Callable[[Dict[str, object]], Awaitable[None]]) -> DangerStream:
+        stream = DangerStream(self.next_stream_id, sample_rate, self.frame_size, notify)
+        self.next_stream_id += 1
+        self.streams[stream.stream_id] = stream
+        return stream
+
+    def unregister(self, stream: DangerStream) -> None:
+        self.streams.pop(stream.stream_id, None)
+
+    async def start(self) -> None:
+        if self.monitor_task is None:
+            self.monitor_task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.monitor_task:
+            self.monitor_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.monitor_task
+            self.monitor_task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                owners = self._collect()
+                if not owners:
+                    continue
+                started = time.monotonic()
+                amplitude, rms, peak, low_share = await loop.run_in_executor(
+                    self.executor, self._analyse, len(owners)
+                )
+                self.batch_seconds.observe(time.monotonic() - started)
+                self.analysed_frames += len(owners)
+                await self._dispatch(owners, amplitude, rms, peak, low_share)
+            except Exception as exc:
+                print(f"Error in danger monitor: {exc}")
+
+    def _ensure_capacity(self, rows: int) -> None:
+        if rows <= len(self._frames):
+            return
+        capacity = max(rows, len(self._frames) * 2, 16)
+        self._frames = np.zeros((capacity, self.frame_size), dtype=np.float32)
+        self._windowed = np.zeros((capacity, self.frame_size), dtype=np.float32)
+        self._rates = np.zeros(capacity, dtype=np.float64)
+
+    def _collect(self) -> List[DangerStream]:
+        pending = sum(stream.filled // self.frame_size for stream in self.streams.values())
+        self._ensure_capacity(pending)
+        owners: List[DangerStream] = []
+        for stream in self.streams.values():
+            taken = stream.take_frames(self.frame_size, self._frames[len(owners) :])
+            self._rates[len(owners) : len(owners) + taken] = stream.sample_rate
+            owners.extend([stream] * taken)
+        return owners
+
+    def _analyse(self, rows: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        frames = self._frames[:rows]
+        magnitude = np.abs(frames)
+        amplitude = magnitude.mean(axis=1)
+        peak = magnitude.max(axis=1)
+        rms = np.sqrt(np.einsum("ij,ij->i", frames, frames) / self.frame_size)
+
+        windowed = np.multiply(frames, self._window, out=self._windowed[:rows])
+        spectrum = np.fft.rfft(windowed, axis=1)
+        power = np.cumsum(spectrum.real ** 2 + spectrum.imag ** 2, axis=1)
+        cutoff = (self.low_band_hz * self.frame_size / self._rates[:rows]).astype(np.int64)
+        cutoff = np.clip(cutoff, 0, power.shape[1] - 1)
+        low_share = power[np.arange(rows), cutoff] / np.maximum(power[:, -1], 1e-12)
+        return amplitude, rms, peak, low_share
+
+    def _classify(self, stream: DangerStream, amplitude: float, rms: float, low_share: float) -> str:
+        rumbling = low_share > self.low_band_share and rms > self.low_band_floor
+        if amplitude > self.high_amplitude:
+            level = "high"
+        elif amplitude > self.medium_amplitude or rumbling:
+            level = "medium"
+        else:
+            level = "none"
 
+        if level == "none" and stream.level != "none":
+            calm = amplitude < self.release_amplitude and (
+                low_share < self.release_low_band_share or rms <= self.low_band_floor
+            )
+            stream.calm_frames = stream.calm_frames + 1 if calm else 0
+            if stream.calm_frames < self.release_frames:
+                return stream.level
+        stream.calm_frames = 0
+        return level
+
+    async def _dispatch(
+        self,
+        owners: List[DangerStream],
+        amplitude: np.ndarray,
+        rms: np.ndarray,
+        peak: np.ndarray,
+        low_share: np.ndarray,
+    ) -> None:
+        alerts: Dict[int, Tuple[DangerStream, Dict[str, object]]] = {}
+        now = time.time()
+        for row, stream in enumerate(owners):
+            previous = stream.level
+            stream.level = self._classify(stream, float(amplitude[row]), float(rms[row]), float(low_share[row]))
+            if stream.level == "none":
+                continue
+            escalated = previous == "none" or (previous == "medium" and stream.level == "high")
+            if escalated or now - stream.last_alert_at >= self.repeat_interval:
+                stream.last_alert_at = now
+                alerts[stream.stream_id] = (
+                    stream,
+                    {
+                        "type": "danger_alert",
+                        "level": stream.level,
+                        "timestamp": now,
+                        "amplitude": float(amplitude[row]),
+                        "rms": float(rms[row]),
+                        "peak": float(peak[row]),
+                        "low_freq": float(low_share[row]),
+                    },
+                )
+        if not alerts:
+            return
+        self.alerts_sent += len(alerts)
+        sends = [stream.notify(alert) for stream, alert in alerts.values()]
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.gather(*sends, return_exceptions=True), timeout=self.interval * 4)
 
+    def render_metrics(self) -> List[str]:
+        lines = self.batch_seconds.render("danger_batch_seconds", "Time spent analysing one batch of audio frames.")
+        lines += render_metric("danger_streams", "gauge", "Audio streams under danger monitoring.", len(self.streams))
+        lines += render_metric("danger_frames_total", "counter", "Audio frames analysed.", self.analysed_frames)
+        lines += render_metric("danger_alerts_total", "counter", "Danger alerts sent.", self.alerts_sent)
+        return lines
 
-def modify_audio_frequency(audio_data: np.ndarray, frequency_modifier: float, sample_rate: int) -> np.ndarray:
 
-    try:
-        if frequency_modifier == 1.0:
-            return audio_data
+audio_executor: ThreadPoolExecutor
+audio_metrics = AudioMetrics()
+danger_monitor: DangerMonitor
+
 
-        audio_float = audio_data.astype(np.float32) / 32768.0
-        new_length = max(1, int(len(audio_float) / frequency_modifier))
-        old_indices = np.arange(len(audio_float))
-        new_indices = np.linspace(0, len(audio_float) - 1, new_length)
-        modified_audio = np.interp(new_indices, old_indices, audio_float)
-        return (modified_audio * 32768.0).astype(np.int16)
-    except Exception as exc:
-        print(f"Error in modify_audio_frequency_realtime: {exc}")
-        return audio_data
+def _parse_sample_rate(value: object) -> Optional[Union[int, float]]:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value if math.isfinite(value) and value > 0 else None
 
 
 @app.websocket("/ws/audio")
 async def audio_websocket(websocket: WebSocket):
     await websocket.accept()
+    audio_metrics.socket.connected()
+    pipeline = AudioPipeline(websocket, audio_executor, audio_metrics)
+    pipeline.start()
+    sample_rate = 44100
+    frequency_modifier = 1.0
+    danger = danger_monitor.register(sample_rate, functools.partial(audio_metrics.socket.send_json, websocket))
 
     try:
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                break
+
+            chunk = received.get("bytes")
+            if chunk is not None:
+                samples = np.frombuffer(chunk, dtype="<i2", count=len(chunk) // 2)
+                danger.append(samples)
+                pipeline.submit(samples, frequency_modifier, sample_rate, binary=True)
+                continue
+
+            message = json.loads(received["text"])
+            message_rate = _parse_sample_rate(message.get("sample_rate", sample_rate))
+            if message_rate is None:
+                print(f"Rejected audio message with invalid sample_rate: {message.get('sample_rate')!r}")
+                continue
 
             if message.get("type") == "audio_chunk":
+                try:
+                    samples = np.asarray(message.get("audio_data", []), dtype=np.int16)
+                except (TypeError, ValueError) as exc:
+                    print(f"Error in real-time audio processing: {exc}")
+                    continue
+                danger.sample_rate = message_rate
+                danger.append(samples)
                 continue
 
-            if message.get("type") == "amplitude":
-                amplitude = message.get("amplitude", 0)
-                low_freq = message.get("low_freq", 0)
-                if amplitude > 0.7 or low_freq > 0.6:
-                    await websocket.send_json(
-                        {
-                            "type": "danger_alert",
-                            "level": "high" if amplitude > 0.85 else "medium",
-                            "timestamp": time.time(),
-                        }
-                    )
+            if message.get("type") == "audio_config":
+                sample_rate = message_rate
+                danger.sample_rate = sample_rate
+                try:
+                    frequency_modifier = float(message.get("frequency_modifier", frequency_modifier))
+                except (TypeError, ValueError) as exc:
+                    print(f"Error in real-time audio processing: {exc}")
+                    continue
+                await audio_metrics.socket.send_json(
+                    websocket,
+                    {
+                        "type": "audio_config",
+                        "sample_rate": sample_rate,
+                        "frequency_modifier": frequency_modifier,
+                        "encoding": "s16le",
+                    },
+                )
 
             elif message.get("type") == "audio_stream":
+                sample_rate = message_rate
+                danger.sample_rate = sample_rate
                 try:
-                    audio_data = message.get("audio_data", [])
-                    sample_rate = message.get("sample_rate", 44100)
-                    frequency_modifier = message.get("frequency_modifier", 1.0)
-                    audio_array = np.array(audio_data, dtype=np.int16)
-                    modified_audio = modify_audio_frequency(audio_array, frequency_modifier, sample_rate)
-                    await websocket.send_json(
-                        {
-                            "type": "modified_audio_stream",
-                            "audio_data": modified_audio.tolist(),
-                            "sample_rate": sample_rate,
-                        }
-                    )
-                except Exception as exc:
+                    frequency_modifier = float(message.get("frequency_modifier", 1.0))
+                except (TypeError, ValueError) as exc:
                     print(f"Error in real-time audio processing: {exc}")
+                    continue
+                try:
+                    samples = np.asarray(message.get("audio_data", []), dtype=np.int16)
+                except (TypeError, ValueError) as exc:
+                    print(f"Error in real-time audio processing: {exc}")
+                    continue
+                danger.append(samples)
+                pipeline.submit(samples, frequency_modifier, sample_rate, binary=False)
 
     except WebSocketDisconnect:
         pass
+    finally:
+        danger_monitor.unregister(danger)
+        audio_metrics.socket.disconnected()
+        await pipeline.stop()
 
 
 @app.websocket("/ws/map")
 async def map_websocket(websocket: WebSocket):
+    await _serve_map(websocket, DEFAULT_ROOM)
+
+
+@app.websocket("/ws/map/{room_name}")
+async def room_map_websocket(websocket: WebSocket, room_name: str):
+    await _serve_map(websocket, room_name)
+
+
+def _parse_move(entry: Dict[str, object]) -> Optional[Tuple[int, float, float]]:
+    person_id, x, y = entry.get("id"), entry.get("x"), entry.get("y")
+    if isinstance(person_id, int) and isinstance(x, (int, float)) and isinstance(y, (int, float)):
+        if math.isfinite(x) and math.isfinite(y):
+            return person_id, float(x), float(y)
+    return None
+
+
+def _parse_toggle(entry: Dict[str, object]) -> Optional[Tuple[int, Optional[str]]]:
+    person_id, desired_state = entry.get("id"), entry.get("state")
+    if isinstance(person_id, int):
+        return person_id, desired_state if isinstance(desired_state, str) else None
+    return None
+
+
+def _parse_viewport(entry: Dict[str, object]) -> Optional[Tuple[float, float, float, float]]:
+    values = [entry.get(key) for key in ("x", "y", "width", "height")]
+    if not all(isinstance(value, (int, float)) and math.isfinite(value) for value in values):
+        return None
+    x, y, width, height = (float(value) for value in values)
+    if width <= 0 or height <= 0:
+        return None
+    return x, y, x + width, y + height
+
+
+def _parse_heatmap(value: object) -> Optional[int]:
+    if value is True:
+        return MapSubscriber.DEFAULT_HEATMAP_CELL
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+        return value
+    return None
+
+
+async def _serve_map(websocket: WebSocket, room_name: str) -> None:
+    room = await rooms.open(room_name)
+    if room is None:
+        await websocket.close(code=1008 if not rooms.valid_name(room_name) else 1013)
+        return
     await websocket.accept()
-    sender = asyncio.create_task(_map_state_stream(websocket))
+    simulation, map_hub = room.crowd, room.hub
+    map_hub.socket_metrics.connected()
+    params = websocket.query_params
+    subscriber = map_hub.subscribe(params.get("format"))
+    if "heatmap" in params:
+        map_hub.set_heatmap(subscriber, _parse_heatmap(params.get("heatmap")), params.get("positions") != "0")
+    if "viewport" in params:
+        values = params.get("viewport", "").split(",")
+        with contextlib.suppress(ValueError):
+            if len(values) == 4:
+                map_hub.set_viewport(
+                    subscriber,
+                    _parse_viewport(dict(zip(("x", "y", "width", "height"), map(float, values)))),
+                    float(params.get("lod", 0.0)),
+                )
+    sender = asyncio.create_task(_map_state_stream(websocket, subscriber, map_hub.socket_metrics))
+    last_goals_at = -math.inf
     try:
         while True:
             message = await websocket.receive_text()
             payload = json.loads(message)
             action = payload.get("type")
+            room.touch()
             if action == "move_person":
-                person_id = payload.get("id")
-                x = payload.get("x")
-                y = payload.get("y")
-                if isinstance(person_id, int) and isinstance(x, (int, float)) and isinstance(y, (int, float)):
-                    await simulation.apply_move(person_id, float(x), float(y))
+                move = _parse_move(payload)
+                if move is not None:
+                    await simulation.apply_move(*move)
             elif action == "toggle_state":
-                person_id = payload.get("id")
-                desired_state = payload.get("state")
-                if isinstance(person_id, int):
-                    await simulation.toggle_state(person_id, desired_state if isinstance(desired_state, str) else None)
+                toggle = _parse_toggle(payload)
+                if toggle is not None:
+                    await simulation.toggle_state(*toggle)
+            elif action == "batch":
+                moves = [_parse_move(entry) for entry in payload.get("moves") or [] if isinstance(entry, dict)]
+                toggles = [_parse_toggle(entry) for entry in payload.get("toggles") or [] if isinstance(entry, dict)]
+                await simulation.apply_batch(
+                    [move for move in moves if move is not None], [toggle for toggle in toggles if toggle is not None]
+                )
+            elif action == "set_goals":
+                goals = payload.get("goals") or []
+                now = time.monotonic()
+                if now - last_goals_at < GOALS_MIN_INTERVAL:
+                    continue
+                if isinstance(goals, list) and len(goals) <= Crowd.MAX_GOALS and all(
+                    isinstance(goal, (list, tuple))
+                    and len(goal) == 2
+                    and all(isinstance(value, (int, float)) and math.isfinite(value) for value in goal)
+                    for goal in goals
+                ):
+                    last_goals_at = now
+                    await simulation.apply_goals([(float(x), float(y)) for x, y in goals])
+            elif action == "viewport":
+                viewport = _parse_viewport(payload)
+                lod, max_agents = payload.get("lod", 0.0), payload.get("max_agents")
+                map_hub.set_viewport(
+                    subscriber,
+                    viewport,
+                    float(lod) if isinstance(lod, (int, float)) else 0.0,
+                    max_agents if isinstance(max_agents, int) else MapSubscriber.DEFAULT_VIEWPORT_AGENTS,
+                )
             elif action == "reset_map":
                 await simulation.reset()
+            elif action == "subscribe":
+                stream_format = payload.get("format")
+                if isinstance(stream_format, str):
+                    map_hub.set_format(subscriber, stream_format)
+                if "heatmap" in payload or "positions" in payload:
+                    cell_size = _parse_heatmap(payload.get("heatmap", subscriber.heatmap_cell))
+                    map_hub.set_heatmap(subscriber, cell_size, payload.get("positions", True) is not False)
     except WebSocketDisconnect:
         pass
     finally:
+        map_hub.unsubscribe(subscriber)
+        map_hub.socket_metrics.disconnected()
+        room.touch()
         sender.cancel()
         with contextlib.suppress(asyncio.CancelledError):
             await sender
 
 
+@app.websocket("/ws/replay/{room_name}")
+async def replay_websocket(websocket: WebSocket, room_name: str):
+    log = rooms.history(room_name)
+    if log is None or log.last_timestamp == -math.inf:
+        await websocket.close(code=1008)
+        return
+    params = websocket.query_params
+    try:
+        end = float(params.get("end", log.last_timestamp))
+        start = float(params.get("start", end - 60.0))
+        speed = float(params.get("speed", 1.0))
+        resolution = float(params.get("resolution", 0.0))
+    except ValueError:
+        await websocket.close(code=1008)
+        return
+    if not all(math.isfinite(value) for value in (start, end, speed, resolution)) or speed < 0 or resolution < 0:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    encoder = BinaryFrameEncoder() if params.get("format") == "binary" else None
+    metrics = replay_metrics
+    metrics.connected()
+    sent = 0
+    previous: Optional[float] = None
+    try:
+        await metrics.send_json(
+            websocket,
+            {
+                "type": "replay_start",
+                "start": start,
+                "end": end,
+                "speed": speed,
+                "format": "binary" if encoder is not None else "json",
+                "map": {"width": collision_field.width, "height": collision_field.height},
+            },
+        )
+        for frame in log.iter_frames(start, end, resolution):
+            if previous is not None and speed > 0:
+                await asyncio.sleep(max(0.0, (frame.timestamp - previous) / speed))
+            previous = frame.timestamp
+            if encoder is not None:
+                payload: Union[bytes, str] = encoder.encode(frame)
+            else:
+                state = frame.to_state(collision_field.width, collision_field.height)
+                payload = dumps_json({"type": "replay", "tick": frame.tick, **state}).decode()
+            await metrics.send(websocket, payload)
+            sent += 1
+        await metrics.send_json(websocket, {"type": "replay_end", "frames": sent})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        metrics.disconnected()
+
+
 @app.get("/map/meta")
 async def map_meta():
     return {"width": collision_field.width, "height": collision_field.height}
 
 
+@app.get("/map/state")
+async def map_state(room: str = DEFAULT_ROOM):
+    selected = rooms.get(room)
+    if selected is None:
+        raise HTTPException(status_code=404, detail=f"Unknown room {room}")
+    return Response(selected.crowd.encoded_state(), media_type="application/json")
+
+
+@app.get("/map/rooms")
+async def map_rooms():
+    return rooms.metrics()
+
+
+@app.get("/map/subscribers")
+async def map_subscribers(room: str = DEFAULT_ROOM):
+    selected = rooms.get(room)
+    if selected is None:
+        raise HTTPException(status_code=404, detail=f"Unknown room {room}")
+    return selected.hub.metrics()
+
+
+def _history_or_404(room: str) -> TrajectoryLog:
+    log = rooms.history(room)
+    if log is None:
+        raise HTTPException(status_code=404, detail=f"No trajectory log for room {room}")
+    return log
+
+
+@app.get("/map/heatmap")
+async def map_heatmap(room: str = DEFAULT_ROOM, cell: int = MapSubscriber.DEFAULT_HEATMAP_CELL, format: str = "png"):
+    selected = rooms.get(room)
+    if selected is None:
+        raise HTTPException(status_code=404, detail=f"Unknown room {room}")
+    density = selected.crowd.density
+    cell = int(np.clip(cell, density.cell_size, MapSubscriber.MAX_HEATMAP_CELL))
+    if format == "raw":
+        frame = await selected.crowd.latest()
+        return Response(density.encode(frame.tick, frame.timestamp, cell), media_type="application/octet-stream")
+    raster, peak = density.raster(cell)
+    encoded, image = cv2.imencode(".png", raster)
+    if not encoded:
+        raise HTTPException(status_code=500, detail="Could not encode heatmap")
+    return Response(image.tobytes(), media_type="image/png", headers={"X-Heatmap-Peak": f"{peak:.4f}"})
+
+
+@app.get("/map/history/bounds")
+async def map_history_bounds(room: str = DEFAULT_ROOM):
+    return {"room": room, **_history_or_404(room).bounds()}
+
+
+@app.get("/map/history")
+async def map_history(
+    room: str = DEFAULT_ROOM,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    resolution: float = 1.0,
+    max_frames: int = 600,
+):
+    given = [value for value in (start, end, resolution) if value is not None]
+    if not all(math.isfinite(value) for value in given) or resolution < 0:
+        raise HTTPException(status_code=422, detail="start, end and resolution must be finite; resolution >= 0")
+    log = _history_or_404(room)
+    end = log.last_timestamp if end is None else end
+    start = end - 60.0 if start is None else start
+    resolution, frames = log.query(start, end, resolution, max_frames=min(max(1, max_frames), 5000))
+    return {
+        "room": room,
+        "start": start,
+        "end": end,
+        "resolution": resolution,
+        "frames": [
+            {"tick": frame.tick, **frame.to_state(collision_field.width, collision_field.height)} for frame in frames
+        ],
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    lines = rooms.render_metrics()
+    lines += replay_metrics.render_metrics()
+    lines += audio_metrics.render_metrics()
+    lines += danger_monitor.render_metrics()
+    lines += profiler.render_metrics()
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+@app.post("/debug/profiler")
+async def toggle_profiler(enabled: bool, clear: bool = False):
+    if clear:
+        profiler.clear()
+    if enabled:
+        profiler.start()
+    else:
+        profiler.stop()
+    return {"enabled": profiler.enabled, "samples": profiler.samples, "interval": profiler.interval}
+
+
+@app.get("/debug/profiler")
+async def profiler_stacks():
+    return PlainTextResponse(profiler.collapsed())
+
+
 @app.get("/map/image")
 async def map_image():
     return FileResponse(str(MAP_PATH))
@@ -536,3 +3488,243 @@ async def root():
 @app.get("/health")
 async def health():
     return {"status": "healthy"}
+
+
+def prebuild_field(args: argparse.Namespace) -> None:
+    artifact_dir = args.cache_dir / CollisionField.cache_key(args.map.read_bytes())
+    if args.force:
+        shutil.rmtree(artifact_dir, ignore_errors=True)
+    started = time.monotonic()
+    field = CollisionField(args.map, cache_dir=args.cache_dir)
+    print(
+        f"{artifact_dir} ready in {time.monotonic() - started:.2f}s "
+        f"({field.width}x{field.height}, {field.walkable_count} walkable pixels)"
+    )
+
+
+HEADLESS_EPOCH = 1_700_000_000.0
+
+
+class TrajectoryRecorder:
+    def __init__(self):
+        self.offsets = [0]
+        self.ids: List[np.ndarray] = []
+        self.positions: List[np.ndarray] = []
+        self.is_large: List[np.ndarray] = []
+        self.digest = hashlib.sha256()
+
+    def __call__(self, crowd: Crowd) -> None:
+        frame = crowd._last_frame
+        self.offsets.append(self.offsets[-1] + len(frame.ids))
+        self.ids.append(frame.ids)
+        self.positions.append(frame.positions)
+        self.is_large.append(frame.is_large)
+        for array in (frame.ids, frame.positions, frame.is_large):
+            self.digest.update(array.tobytes())
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "offsets": np.asarray(self.offsets, dtype=np.int64),
+            "ids": np.concatenate(self.ids) if self.ids else np.empty(0, dtype=np.int64),
+            "positions": np.concatenate(self.positions) if self.positions else np.empty((0, 2), dtype=np.float32),
+            "is_large": np.concatenate(self.is_large) if self.is_large else np.empty(0, dtype=np.bool_),
+        }
+
+    def save(self, path: Path, meta: Dict[str, object]) -> None:
+        np.savez_compressed(path, meta=np.array(json.dumps(meta)), **self.arrays())
+
+
+def headless_crowd(
+    field: CollisionField, seed: int, agents: int, goals: Optional[Sequence[Tuple[float, float]]] = None
+) -> Tuple[Crowd, SimulatedClock]:
+    clock = SimulatedClock(HEADLESS_EPOCH)
+    crowd = Crowd(field, max_agents=agents, crowd_size=agents, seed=seed, clock=clock)
+    crowd.set_goals(goals)
+    return crowd, clock
+
+
+def run_ticks(
+    crowd: Crowd,
+    clock: SimulatedClock,
+    ticks: int,
+    rate_hz: float = 30.0,
+    on_tick: Optional[Callable[[Crowd], None]] = None,
+) -> float:
+    dt = 1.0 / rate_hz
+    started = time.perf_counter()
+    for _ in range(ticks):
+        crowd.tick(clock.advance(dt), dt)
+        if on_tick is not None:
+            on_tick(crowd)
+    return time.perf_counter() - started
+
+
+def _simulate_recorded(field: CollisionField, meta: Dict[str, object]) -> Tuple[TrajectoryRecorder, float]:
+    goals = [tuple(goal) for goal in meta["goals"]]
+    crowd, clock = headless_crowd(field, meta["seed"], meta["agents"], goals)
+    recorder = TrajectoryRecorder()
+    elapsed = run_ticks(crowd, clock, meta["ticks"], meta["rate_hz"], on_tick=recorder)
+    return recorder, elapsed
+
+
+def simulate(args: argparse.Namespace) -> None:
+    field = CollisionField(args.map, cache_dir=args.cache_dir, seed=args.seed)
+    meta = {
+        "seed": args.seed,
+        "agents": args.agents,
+        "ticks": args.ticks,
+        "rate_hz": args.rate,
+        "goals": [list(goal) for goal in args.goal],
+        "map": str(args.map),
+        "map_sha256": hashlib.sha256(args.map.read_bytes()).hexdigest(),
+    }
+    recorder, elapsed = _simulate_recorded(field, meta)
+    meta["digest"] = recorder.digest.hexdigest()
+    if args.record is not None:
+        recorder.save(args.record, meta)
+    print(
+        f"{args.ticks} ticks x {args.agents} agents in {elapsed:.3f}s "
+        f"({args.ticks / max(elapsed, 1e-9):.1f} ticks/s), digest {meta['digest']}"
+    )
+
+
+def replay(args: argparse.Namespace) -> None:
+    with np.load(args.recording) as recording:
+        meta = json.loads(str(recording["meta"]))
+        recorded = {name: recording[name] for name in ("offsets", "ids", "positions", "is_large")}
+    map_path = Path(meta["map"])
+    if hashlib.sha256(map_path.read_bytes()).hexdigest() != meta["map_sha256"]:
+        raise SystemExit(f"{map_path} no longer matches the recorded map")
+    field = CollisionField(map_path, cache_dir=args.cache_dir, seed=meta["seed"])
+    recorder, _ = _simulate_recorded(field, meta)
+    if recorder.digest.hexdigest() == meta["digest"]:
+        print(f"Replay of {meta['ticks']} ticks is identical (digest {meta['digest']})")
+        return
+    replayed = recorder.arrays()
+    offsets = recorded["offsets"]
+    for tick in range(meta["ticks"]):
+        span = slice(offsets[tick], offsets[tick + 1])
+        other = slice(replayed["offsets"][tick], replayed["offsets"][tick + 1])
+        names = ("ids", "positions", "is_large")
+        if any(not np.array_equal(recorded[name][span], replayed[name][other]) for name in names):
+            raise SystemExit(f"Replay diverges from the recording at tick {tick + 1}")
+    raise SystemExit("Replay digest differs from the recording")
+
+
+def benchmark(args: argparse.Namespace) -> None:
+    field = CollisionField(args.map, cache_dir=args.cache_dir, seed=args.seed)
+    results = []
+    for agents in args.agents:
+        crowd, clock = headless_crowd(field, args.seed, agents, args.goal)
+        run_ticks(crowd, clock, args.warmup, args.rate)
+        crowd.phases.reset()
+        elapsed = run_ticks(crowd, clock, args.ticks, args.rate)
+        phase_totals = dict(crowd.phases.totals)
+
+        tracemalloc.start()
+        run_ticks(crowd, clock, min(args.ticks, 20), args.rate)
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        frame, repeats = crowd._last_frame, 10
+        started = time.perf_counter()
+        for _ in range(repeats):
+            _dumps_stdlib({"type": "state", **frame.to_state(field.width, field.height)})
+        stdlib_seconds = (time.perf_counter() - started) / repeats
+        started = time.perf_counter()
+        for _ in range(repeats):
+            frame.encode_state(field.width, field.height)
+        encode_seconds = (time.perf_counter() - started) / repeats
+
+        results.append(
+            {
+                "agents": agents,
+                "ticks": args.ticks,
+                "ticks_per_second": args.ticks / max(elapsed, 1e-9),
+                "tick_ms": elapsed * 1000.0 / args.ticks,
+                "phase_ms": {name: total * 1000.0 / args.ticks for name, total in phase_totals.items()},
+                "agent_arrays_mb": crowd.agents.nbytes / 2**20,
+                "tick_alloc_peak_mb": traced_peak / 2**20,
+                "state_json_ms": stdlib_seconds * 1000.0,
+                "state_encode_ms": encode_seconds * 1000.0,
+            }
+        )
+
+    header = [
+        "agents",
+        "ticks/s",
+        "tick ms",
+        *(f"{name} ms" for name in Crowd.PHASES),
+        "arrays MB",
+        "peak MB",
+        "json ms",
+        f"{JSON_ENCODER} ms",
+    ]
+    print("  ".join(f"{column:>11}" for column in header))
+    for result in results:
+        row = [
+            result["agents"],
+            result["ticks_per_second"],
+            result["tick_ms"],
+            *result["phase_ms"].values(),
+            result["agent_arrays_mb"],
+            result["tick_alloc_peak_mb"],
+            result["state_json_ms"],
+            result["state_encode_ms"],
+        ]
+        print("  ".join(f"{value:>11}" if isinstance(value, int) else f"{value:>11.3f}" for value in row))
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=2))
+
+
+def _parse_point(value: str) -> Tuple[float, float]:
+    x, y = value.split(",")
+    return float(x), float(y)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Crowd simulation backend utilities.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    prebuild = commands.add_parser("prebuild-field", help="Build the cached collision-field artifact for a map.")
+    prebuild.add_argument("--map", type=Path, default=MAP_PATH)
+    prebuild.add_argument("--cache-dir", type=Path, default=COLLISION_CACHE_DIR)
+    prebuild.add_argument("--force", action="store_true", help="Rebuild even if a matching artifact exists.")
+    prebuild.set_defaults(handler=prebuild_field)
+
+    simulate_parser = commands.add_parser("simulate", help="Run the simulation headless as fast as possible.")
+    simulate_parser.add_argument("--seed", type=int, default=0)
+    simulate_parser.add_argument("--map", type=Path, default=MAP_PATH)
+    simulate_parser.add_argument("--cache-dir", type=Path, default=COLLISION_CACHE_DIR)
+    simulate_parser.add_argument("--agents", type=int, default=MAX_AGENTS)
+    simulate_parser.add_argument("--ticks", type=int, default=300)
+    simulate_parser.add_argument("--rate", type=float, default=30.0, help="Simulated tick rate in Hz.")
+    simulate_parser.add_argument("--goal", type=_parse_point, action="append", default=[], metavar="X,Y")
+    simulate_parser.add_argument("--record", type=Path, help="Write the trajectory to this .npz file.")
+    simulate_parser.set_defaults(handler=simulate)
+
+    replay_parser = commands.add_parser("replay", help="Re-run a recorded simulation and check it is identical.")
+    replay_parser.add_argument("recording", type=Path)
+    replay_parser.add_argument("--cache-dir", type=Path, default=COLLISION_CACHE_DIR)
+    replay_parser.set_defaults(handler=replay)
+
+    bench = commands.add_parser("benchmark", help="Report tick throughput, phase timings and memory.")
+    bench.add_argument("--seed", type=int, default=0)
+    bench.add_argument("--map", type=Path, default=MAP_PATH)
+    bench.add_argument("--cache-dir", type=Path, default=COLLISION_CACHE_DIR)
+    bench.add_argument(
+        "--agents", type=lambda value: [int(count) for count in value.split(",")], default=[10, 1000, 10000]
+    )
+    bench.add_argument("--ticks", type=int, default=200)
+    bench.add_argument("--warmup", type=int, default=20)
+    bench.add_argument("--rate", type=float, default=30.0)
+    bench.add_argument("--goal", type=_parse_point, action="append", default=[], metavar="X,Y")
+    bench.add_argument("--json", type=Path, help="Also write the results to this JSON file.")
+    bench.set_defaults(handler=benchmark)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+os.environ["TRAJECTORY_LOG_DIR"] = tempfile.mkdtemp(prefix="crowd-tests-")
+os.environ["CROWD_WORKER_PROCESS"] = "0"
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
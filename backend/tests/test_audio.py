@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from main import StreamingResampler
+
+
+@pytest.mark.parametrize("ratio", [0.5, 0.77, 1.0, 1.3, 2.0])
+def test_resampler_is_chunk_invariant(ratio: float) -> None:
+    rng = np.random.default_rng(int(ratio * 100))
+    samples = (np.sin(2 * np.pi * 440 * np.arange(44100) / 44100) * 12000).astype(np.int16)
+    whole = StreamingResampler(ratio).process(samples)
+
+    resampler = StreamingResampler(ratio)
+    chunks = []
+    start = 0
+    while start < len(samples):
+        size = int(rng.integers(1, 3000))
+        chunks.append(resampler.process(samples[start : start + size]))
+        start += size
+    split = np.concatenate(chunks)
+
+    common = min(len(split), len(whole))
+    assert abs(len(split) - len(whole)) <= 1
+    assert np.array_equal(split[:common], whole[:common])
+    assert abs(len(whole) * ratio - len(samples)) <= 2 * resampler.half_taps
+
+
+def test_resampler_ignores_invalid_ratio() -> None:
+    resampler = StreamingResampler(1.5)
+    for ratio in (0.0, -1.0, float("nan"), float("inf")):
+        resampler.set_ratio(ratio)
+    assert resampler.ratio == 1.5
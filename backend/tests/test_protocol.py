@@ -0,0 +1,110 @@
+from typing import Dict, Tuple
+
+import numpy as np
+import pytest
+
+from main import BinaryFrameEncoder, MapFrame, SharedFrameBuffer
+
+
+def _frame(tick: int, ids: np.ndarray, positions: np.ndarray, is_large: np.ndarray) -> MapFrame:
+    return MapFrame(
+        tick,
+        tick / 30.0,
+        ids,
+        positions.astype(np.float32),
+        is_large,
+        np.full(len(ids), tick / 60.0),
+        {"x": 1.5, "y": 2.5, "confidence": 0.75},
+        {"large": int(is_large.sum()), "small": int((~is_large).sum())},
+    )
+
+
+def _decode(payload: bytes, agents: Dict[int, Tuple[float, float, bool]]) -> Tuple[int, int]:
+    header = BinaryFrameEncoder.HEADER
+    magic, version, kind, _, tick, _, _, _, _, _, _, count = header.unpack_from(payload)
+    assert (magic, version) == (BinaryFrameEncoder.MAGIC, BinaryFrameEncoder.VERSION)
+    offset = header.size + 8 * count
+    ids = np.frombuffer(payload, "<u4", count, offset)
+    offset += 4 * count
+    positions = np.frombuffer(payload, "<f4", 2 * count, offset).reshape(count, 2)
+    offset += 8 * count
+    states = np.frombuffer(payload, "u1", count, offset)
+    assert offset + count == len(payload)
+    if kind == BinaryFrameEncoder.KEYFRAME:
+        agents.clear()
+    for agent_id, (x, y), state in zip(ids.tolist(), positions.tolist(), states.tolist()):
+        agents[agent_id] = (x, y, bool(state & BinaryFrameEncoder.STATE_LARGE))
+    return kind, tick
+
+
+@pytest.mark.parametrize("epsilon", [0.0, 0.25])
+def test_binary_frames_round_trip(epsilon: float) -> None:
+    rng = np.random.default_rng(3)
+    encoder = BinaryFrameEncoder(keyframe_interval=10, position_epsilon=epsilon)
+    ids = np.arange(20, dtype=np.int64)
+    positions = rng.uniform(0, 500, (20, 2))
+    is_large = rng.random(20) < 0.3
+    next_id = 20
+    agents: Dict[int, Tuple[float, float, bool]] = {}
+    kinds = []
+    for tick in range(1, 80):
+        positions = positions + rng.normal(0, 0.3, positions.shape)
+        is_large = is_large ^ (rng.random(len(ids)) < 0.05)
+        if tick % 7 == 0:
+            ids = np.append(ids, next_id)
+            positions = np.vstack((positions, rng.uniform(0, 500, (1, 2))))
+            is_large = np.append(is_large, False)
+            next_id += 1
+        if tick % 23 == 0:
+            keep = rng.random(len(ids)) > 0.2
+            ids, positions, is_large = ids[keep], positions[keep], is_large[keep]
+        frame = _frame(tick, ids, positions, is_large)
+        kind, decoded_tick = _decode(encoder.encode(frame), agents)
+        kinds.append(kind)
+
+        assert decoded_tick == tick
+        assert sorted(agents) == ids.tolist()
+        decoded = np.array([agents[agent_id][:2] for agent_id in ids.tolist()])
+        assert np.abs(decoded - frame.positions).max() <= epsilon + 1e-6
+        assert [agents[agent_id][2] for agent_id in ids.tolist()] == is_large.tolist()
+    assert BinaryFrameEncoder.KEYFRAME in kinds and BinaryFrameEncoder.DELTA in kinds
+
+
+def test_keyframe_matches_encoder_state() -> None:
+    encoder = BinaryFrameEncoder()
+    ids = np.arange(5, dtype=np.int64)
+    positions = np.arange(10, dtype=np.float64).reshape(5, 2)
+    encoder.encode(_frame(1, ids, positions, np.zeros(5, dtype=np.bool_)))
+    frame = _frame(2, ids, positions + 0.1, np.zeros(5, dtype=np.bool_))
+    encoder.encode(frame)
+
+    agents: Dict[int, Tuple[float, float, bool]] = {}
+    kind, _ = _decode(encoder.keyframe(frame), agents)
+    assert kind == BinaryFrameEncoder.KEYFRAME
+    assert sorted(agents) == ids.tolist()
+
+
+def test_shared_frame_buffer_round_trip() -> None:
+    frames = SharedFrameBuffer(8)
+    try:
+        assert frames.read() is None
+        ids = np.array([3, 5, 9], dtype=np.int64)
+        frame = _frame(42, ids, np.array([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]]), np.array([True, False, True]))
+        frames.write(frame)
+        read = SharedFrameBuffer(8, name=frames.name)
+        try:
+            copy = read.read()
+            assert copy is not None and copy.tick == 42 and copy.timestamp == frame.timestamp
+            assert np.array_equal(copy.ids, ids)
+            assert np.array_equal(copy.positions, frame.positions)
+            assert np.array_equal(copy.is_large, frame.is_large)
+            assert np.array_equal(copy.last_unshrinked_at, frame.last_unshrinked_at)
+            assert copy.counts == frame.counts
+            assert copy.fhu == pytest.approx(frame.fhu)
+
+            frames.write_metrics(["crowd_ticks_total 7"])
+            assert read.read_metrics() == ["crowd_ticks_total 7"]
+        finally:
+            read.close()
+    finally:
+        frames.close(unlink=True)
@@ -0,0 +1,58 @@
+import json
+import math
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as client:
+        yield client
+
+
+def _next_state(websocket) -> dict:
+    while True:
+        message = json.loads(websocket.receive_text())
+        if message.get("type") == "state":
+            return message
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        '{"type": "move_person", "id": %d, "x": NaN, "y": 5}',
+        '{"type": "move_person", "id": %d, "x": 5, "y": Infinity}',
+        '{"type": "batch", "moves": [{"id": %d, "x": NaN, "y": NaN}]}',
+        '{"type": "set_goals", "goals": [[NaN, 1]], "id": %d}',
+        '{"type": "viewport", "x": NaN, "y": 0, "width": 10, "height": 10, "lod": NaN, "id": %d}',
+    ],
+)
+def test_non_finite_commands_keep_room_running(client: TestClient, message: str) -> None:
+    with client.websocket_connect("/ws/map") as websocket:
+        first = _next_state(websocket)
+        websocket.send_text(message % first["people"][0]["id"])
+        websocket.send_text('{"type": "viewport"}')
+        timestamps = [_next_state(websocket)["timestamp"] for _ in range(5)]
+
+    assert timestamps == sorted(timestamps) and timestamps[0] > first["timestamp"]
+    assert not main.rooms.tick_task.done()
+    assert not main.rooms.publish_task.done()
+    assert main.rooms.get("default").failures == {"tick": 0, "publish": 0}
+    people = client.get("/map/state").json()["people"]
+    assert all(math.isfinite(person["x"]) and math.isfinite(person["y"]) for person in people)
+
+
+def test_queued_non_finite_move_is_ignored(client: TestClient) -> None:
+    crowd = main.Crowd(main.collision_field, max_agents=5)
+    crowd.tick(0.0, 1 / 30)
+    people = json.loads(crowd.encoded_state())["people"]
+    crowd.queue_move(people[0]["id"], float("nan"), 5.0)
+    crowd.queue_batch([(people[1]["id"], 5.0, float("inf"))], [])
+    for step in range(1, 4):
+        crowd.tick(step / 30, 1 / 30)
+
+    people = json.loads(crowd.encoded_state())["people"]
+    assert people and all(math.isfinite(person["x"]) and math.isfinite(person["y"]) for person in people)
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from main import SpatialHashGrid
+
+
+@pytest.mark.parametrize("cell_size", [4.0, 25.0, 300.0])
+def test_query_rect_matches_brute_force(cell_size: float) -> None:
+    rng = np.random.default_rng(int(cell_size))
+    positions = rng.uniform(-50, 1000, (2000, 2)).astype(np.float32)
+    grid = SpatialHashGrid(cell_size)
+    grid.rebuild(positions)
+
+    for _ in range(200):
+        x0, y0 = rng.uniform(-200, 1100, 2)
+        x1, y1 = x0 + rng.uniform(0, 400), y0 + rng.uniform(0, 400)
+        inside = (
+            (positions[:, 0] >= x0) & (positions[:, 0] <= x1) & (positions[:, 1] >= y0) & (positions[:, 1] <= y1)
+        )
+        assert grid.query_rect(x0, y0, x1, y1).tolist() == np.flatnonzero(inside).tolist()
+
+
+def test_query_rect_empty_grid() -> None:
+    grid = SpatialHashGrid(10.0)
+    grid.rebuild(np.empty((0, 2), dtype=np.float32))
+    assert len(grid.query_rect(0, 0, 100, 100)) == 0